@@ -1,170 +1,381 @@
-"""Benchmark for various g13 code.
+"""Benchmarks for the g13 and stately pipeline.
 
-Benchmarks the difference between A1 and RGB24 memory layouts and also between
-python and C++ (via weave) implementations of the conversion layer.
+Covers each stage a key report goes through: decoding, PluginState dispatch at
+several stack depths and handler counts, LCD framebuffer packing, and all of
+them together from a FakeTransport to a backend that drops the actions. No G13,
+desktop session or cairo is needed. The numpy LCD packing benchmarks are left
+out when numpy isn't installed.
+
+Each benchmark is timed over enough calls to take at least --min-time seconds,
+--repeat times, keeping the fastest run. Results can be written as JSON and
+compared against an earlier run's:
+
+  python benchmark.py --json before.json
+  python benchmark.py --baseline before.json
+
+which exits non-zero if anything got more than --threshold slower.
 """
-import math
-import struct
+import argparse
+import json
+import os
+import platform
+import random
+import sys
 import time
 
-import cairo
-from scipy import weave
-
-def python_a1(source, dest, width):
-  row, col = 0, 0
-  for pixels in source:
-    pixels = pixels
-    for i in xrange(8):
-      pixel = pixels & 1
-      pixels >>= 1
-      idx = 32 + col + (row/8)*width
-      if pixel:
-        dest[idx] |= 1 << (row % 8)
-      else:
-        dest[idx] &= ~(1 << (row % 8))
-
-      col += 1
-      if col >= width:
-        row += 1
-        col = 0
-
-def weave_a1(source, dest, width):
-  c_code = """
-  char* dest_buf = PyByteArray_AsString(dest);
-
-  int row = 0, col = 0;
-  for (int pi=0; pi < source.len(); pi++) {
-    int pixels = source[pi];
-    for (int di=0; di < 8; di++) {
-
-      int pixel = pixels & 1;
-      pixels >>= 1;
-      int idx = 32 + col + (row >> 3) * %(width)s;
-      if (pixel)
-        dest_buf[idx] |= 1 << (row & 0x07);
-      else
-        dest_buf[idx] &= ~(1 << (row & 0x07));
-
-      col++;
-      if (col >= %(width)s) {
-        col = 0;
-        row++;
-      }
-    }
-  }
-  """ % {'width': width}
-  weave.inline(c_code, ['source', 'dest'])
-
-
-def python_rgb(source, dest, width):
-  threshold = 128
-  row, col = 0, 0
-  for pi in xrange(len(source)/4):
-    data = source[pi*4:pi*4+4]
-    pixel = data[1] > threshold and data[2] > threshold and data[3] > threshold
-    idx = 32 + col + (row / 8) * width
-    if pixel:
-      dest[idx] |= 1 << (row % 8)
-    else:
-      dest[idx] &= ~(1 << (row % 8))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'stately'))
+
+import g13
+from g13 import FakeTransport, G13
+import lcd
+from actions import ActionHelper
+from g13_handler import G13Handler, G13Keys, KeyDecoder
+from state import PluginState
+
+# name -> function returning (run, operations per call of run).
+BENCHMARKS = []
+
+def benchmark(name):
+  def register(func):
+    BENCHMARKS.append((name, func))
+    return func
+  return register
+
+
+def make_reports(count=1024, seed=0):
+  """Returns raw reports with the stick drifting and a key changing in each."""
+  rng = random.Random(seed)
+  reports = []
+  report = bytearray([1, 127, 127, 0, 0, 0, 0, 0])
+  for _ in range(count):
+    report[1] = min(255, max(0, report[1] + rng.randint(-4, 4)))
+    report[2] = min(255, max(0, report[2] + rng.randint(-4, 4)))
+    bit = rng.randrange(39)
+    report[3 + bit // 8] ^= 1 << (bit % 8)
+    reports.append(bytes(report))
+  return reports
+
 
-    col += 1
-    if col >= width:
-      row += 1
-      col = 0
+class InjectingPlugin(object):
+  """Presses and releases a key for every key event, like most plugins."""
+  def press(self, state_obj, key):
+    state_obj.action.press_key('a')
+  def release(self, state_obj, key):
+    state_obj.action.release_key('a')
+  def joystick(self, state_obj, stick_x, stick_y):
+    pass
 
+  def register(self, state_obj, state_name, keys):
+    state_obj.register_plugin(states={
+      state_name: {
+        'joystick': self.joystick,
+        'key_press': {key: self.press for key in keys},
+        'key_release': {key: self.release for key in keys},
+      },
+    })
 
-def weave_rgb(source, dest, width):
-  threshold = 128
-  support_code = """
-  #define RGB_R(x) ((x&0x00FF0000) >> 16)
-  #define RGB_G(x) ((x&0x0000FF00) >> 8)
-  #define RGB_B(x) ((x&0x000000FF) >> 0)
+
+def make_state(handler, depth=1, handlers=1, keys=None):
+  """Returns a PluginState with depth states entered, each state having
+  handlers plugins registered for keys, every G13 key by default.
   """
-  c_code = """
-  Py_buffer source_buffer;
-  PyObject_GetBuffer(source, &source_buffer, PyBUF_WRITABLE);
-
-  unsigned int* source_buf = (unsigned int*)source_buffer.buf;
-  int source_len = source_buffer.len;
-
-  char* dest_buf = PyByteArray_AsString(dest);
-
-  int row = 0, col = 0;
-  for (int pi=0; pi < source_len / 4; pi++) {
-    int pix = source_buf[pi];
-    bool pixel = RGB_R(pix) > %(threshold)s ||
-                 RGB_G(pix) > %(threshold)s ||
-                 RGB_B(pix) > %(threshold)s;
-    int idx = 32 + col + (row >> 3) * %(width)s;
-    if (pixel)
-      dest_buf[idx] |= 1 << (row & 0x07);
-    else
-      dest_buf[idx] &= ~(1 << (row & 0x07));
-
-    col++;
-    if (col >= %(width)s) {
-      col = 0;
-      row++;
-    }
-  }
-  """ % {'width': width, 'threshold': threshold}
-  weave.inline(c_code, ['source', 'dest'], support_code=support_code)
-
-def benchmark_rgb(func, n=10):
-  width = 160
-  height = 44
-  surface = cairo.ImageSurface(
-      cairo.FORMAT_RGB24, width, height)
-  source = surface.get_data()
-  dest = bytearray(32 + 960+30)
-
-  start = time.time()
-  for i in xrange(n):
-    func(source, dest, width)
-  return time.time() - start
-
-def benchmark_a1(func, n=10):
-  width = 160
-  height = 44
-  surface = cairo.ImageSurface(
-      cairo.FORMAT_A1, width, height)
-  context = cairo.Context(surface)
-  text = 'Benchmark Text'
-
-  context.set_source_rgb(1, 1, 1)
-  context.select_font_face('Verdana')
-  context.set_font_size(20)
-  height = context.text_extents(text)[3]
-  context.move_to(0, height)
-  context.show_text(text)
-
-  source = bytearray(surface.get_data())
-  dest = bytearray(32 + 960)
-
-  start = time.time()
-  for i in xrange(n):
-    func(source, dest, width)
-  return time.time() - start
-
-def benchmark_generic(benchmark_func, func_list):
-  for func in func_list:
-    print 'Running %s on %s' % (
-        benchmark_func.__name__, func.__name__)
-    n = 1
-    while True:
-      dur = benchmark_func(func, n)
-      print '%s took %.3fs or %s each' % (n, dur, dur/n)
-      if dur > 1:
-        break
-      if dur < 0.1:
-        prevn = n
-        n = int(2**math.ceil(math.log(n/dur)))
-        if n <= prevn:
-          n = prevn * 2
+  keys = list(keys or G13Keys.keys)
+  state_obj = PluginState(handler, ActionHelper('null'))
+  for level in range(depth):
+    for _ in range(handlers):
+      InjectingPlugin().register(state_obj, 'state%d' % level, keys)
+  for level in range(depth):
+    state_obj.enter_state('state%d' % level)
+  return state_obj
+
+
+def key_bytes(reports):
+  return [bytearray(report[3:]) for report in reports]
+
+
+# Decoding
+@benchmark('decode.diff_keys')
+def bench_diff_keys():
+  handler = G13Handler(G13(FakeTransport(script=())))
+  keys = key_bytes(make_reports())
+  def run():
+    diff_keys = handler.diff_keys
+    for new_keys in keys:
+      diff_keys(new_keys)
+  return run, len(keys)
+
+@benchmark('decode.bit_loop')
+def bench_bit_loop():
+  """diff_keys then the per-bit loop listen_for_keys used to run."""
+  handler = G13Handler(G13(FakeTransport(script=())))
+  keys = key_bytes(make_reports())
+  names = G13Keys.bytes
+  def run():
+    events = []
+    for new_keys in keys:
+      for i, byte in enumerate(handler.diff_keys(new_keys)):
+        if not byte:
+          continue
+        for j in range(8):
+          if byte & 1:
+            events.append((names[(i, j)], bool(new_keys[i] & (1 << j))))
+          byte >>= 1
+  return run, len(keys)
+
+@benchmark('decode.key_decoder')
+def bench_key_decoder():
+  decoder = KeyDecoder()
+  keys = key_bytes(make_reports())
+  def run():
+    decode = decoder.decode
+    for new_keys in keys:
+      decode(new_keys)
+  return run, len(keys)
+
+@benchmark('decode.parse_keys')
+def bench_parse_keys():
+  device = G13(FakeTransport(script=()))
+  reports = make_reports()
+  def run():
+    parse_keys = device.parse_keys
+    for report in reports:
+      parse_keys(report)
+  return run, len(reports)
+
+
+# Dispatch
+def dispatch_benchmark(depth, handlers):
+  def setup():
+    handler = G13Handler(G13(FakeTransport(script=())))
+    state_obj = make_state(handler, depth, handlers)
+    decoded = []
+    decoder = KeyDecoder()
+    for report in make_reports():
+      new_keys = handler.g13.parse_keys(report)
+      decoded.append((new_keys._replace(keys=bytearray(new_keys.keys)),
+                      decoder.decode(new_keys.keys)))
+    def run():
+      dispatch_keys = state_obj.dispatch_keys
+      for new_keys, events in decoded:
+        dispatch_keys(new_keys, events)
+    return run, len(decoded)
+  return setup
+
+for depth, handlers in ((1, 1), (1, 4), (4, 1), (16, 1), (4, 4)):
+  benchmark('dispatch.depth%d_handlers%d' % (depth, handlers))(
+      dispatch_benchmark(depth, handlers))
+
+@benchmark('dispatch.enter_exit_state')
+def bench_enter_exit():
+  handler = G13Handler(G13(FakeTransport(script=())))
+  state_obj = make_state(handler, depth=4)
+  InjectingPlugin().register(state_obj, 'top', G13Keys.keys)
+  def run():
+    for _ in range(100):
+      state_obj.enter_state('top')
+      state_obj.exit_state('top')
+  return run, 100
+
+
+# LCD packing
+def lcd_source(fmt, seed=0):
+  rng = random.Random(seed)
+  width, height = G13.LCD_WIDTH, G13.LCD_HEIGHT
+  if fmt == G13.FORMAT_RGB24:
+    size = width * 4 * height
+  else:
+    size = (width + 31) // 32 * 4 * height
+  return bytearray(rng.getrandbits(8) for _ in xrange(size))
+
+def blit_benchmark(fmt, slow):
+  def setup():
+    device = G13(FakeTransport(script=()))
+    source = lcd_source(fmt)
+    blit = device._blit_surface_slow if slow else device.blit_surface
+    def run():
+      if slow:
+        blit(source, fmt, None, 128)
       else:
-        n *= 2
+        blit(source, fmt)
+    return run, 1
+  return setup
+
+for fmt_name, fmt in (('a1', G13.FORMAT_A1), ('rgb24', G13.FORMAT_RGB24)):
+  # Without numpy blit_surface is the _python one, which would make results
+  # under this name incomparable between machines.
+  if g13.numpy is not None:
+    benchmark('lcd.blit_%s' % fmt_name)(blit_benchmark(fmt, False))
+  benchmark('lcd.blit_%s_python' % fmt_name)(blit_benchmark(fmt, True))
+
+def text_benchmark(y):
+  def setup():
+    """Eight 16x40 glyphs, about the size of a clock's, without cairo."""
+    rng = random.Random(0)
+    glyphs = [lcd.Glyph([rng.getrandbits(40) for _ in range(16)], 40)
+              for _ in range(8)]
+    pixels = G13(FakeTransport(script=())).pixels
+    def run():
+      x = 0
+      for glyph in glyphs:
+        glyph.draw(pixels, x, y)
+        x += glyph.width
+    return run, 1
+  return setup
+
+benchmark('lcd.draw_text')(text_benchmark(0))
+benchmark('lcd.draw_text_unaligned')(text_benchmark(3))
+
+@benchmark('lcd.draw_image_cached')
+def bench_draw_image_cached():
+  """Redrawing a full-screen background an ImageCache already holds."""
+  rng = random.Random(0)
+  height = G13.LCD_BANDS * 8
+  bitmap = lcd.Bitmap([rng.getrandbits(height) for _ in range(G13.LCD_WIDTH)],
+                      height)
+  bitmap.packed[0] = lcd.pack_columns(bitmap.columns, height)
+  images = lcd.ImageCache()
+  images.put('background.png', 0, 0, bitmap)
+  device = G13(FakeTransport(script=()))
+  def run():
+    images.draw(device, 'background.png')
+  return run, 1
+
+@benchmark('lcd.write_lcd')
+def bench_write_lcd():
+  device = G13(FakeTransport(script=()))
+  def run():
+    device.pixels[40] ^= 1
+    device.write_lcd()
+  return run, 1
+
+
+# End to end
+@benchmark('e2e.fake_device_sync')
+def bench_e2e_sync():
+  """Reports read from a FakeTransport, decoded and dispatched to actions."""
+  reports = make_reports()
+  transport = FakeTransport(script=(), rate=1e9)
+  handler = G13Handler(G13(transport))
+  state_obj = make_state(handler)
+  def run():
+    transport.reports = iter(reports)
+    for _ in reports:
+      new_keys, events = handler.maybe_get_new_keys()
+      state_obj.dispatch_keys(new_keys, events)
+  return run, len(reports)
+
+@benchmark('e2e.fake_device_async')
+def bench_e2e_async():
+  """Like fake_device_sync, through async transfers and handle_events."""
+  reports = make_reports()
+  transport = FakeTransport(script=(), rate=1e9)
+  handler = G13Handler(G13(transport))
+  state_obj = make_state(handler)
+  def run():
+    transport.reports = iter(reports)
+    handler.start_listening(state_obj.dispatch_keys)
+    while handler.listening:
+      handler.handle_events()
+    handler.handle_events(0)
+    handler.stop_listening()
+  return run, len(reports)
+
+
+def measure(setup, min_time, repeat):
+  """Returns the fastest seconds per operation of repeat runs."""
+  run, ops = setup()
+  run()  # Warm up.
+  calls = 1
+  while True:
+    start = time.time()
+    for _ in xrange(calls):
+      run()
+    elapsed = time.time() - start
+    if elapsed >= min_time:
+      break
+    calls = max(calls * 2, int(calls * min_time / max(elapsed, 1e-6) * 1.2))
+  best = elapsed
+  for _ in range(repeat - 1):
+    start = time.time()
+    for _ in xrange(calls):
+      run()
+    best = min(best, time.time() - start)
+  return best / (calls * ops)
+
+
+def compare(results, baseline, threshold, out=sys.stdout):
+  """Writes results against baseline to out, returns the ones that regressed."""
+  regressed = []
+  for name in sorted(results):
+    if name not in baseline:
+      continue
+    ratio = results[name]['seconds_per_op'] / baseline[name]['seconds_per_op']
+    flag = ''
+    if ratio > 1 + threshold:
+      flag = '  REGRESSED'
+      regressed.append(name)
+    elif ratio < 1 - threshold:
+      flag = '  improved'
+    out.write('%-32s %10.3fus %10.3fus %7.2fx%s\n' % (
+        name, baseline[name]['seconds_per_op'] * 1e6,
+        results[name]['seconds_per_op'] * 1e6, ratio, flag))
+  return regressed
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('filter', nargs='*',
+                      help='Only run benchmarks whose names contain one.')
+  parser.add_argument('--min-time', type=float, default=0.2,
+                      help='Seconds to time each benchmark for at least.')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--json', metavar='PATH',
+                      help="Write results as JSON, '-' for stdout.")
+  parser.add_argument('--baseline', metavar='PATH',
+                      help='Compare against results written with --json.')
+  parser.add_argument('--threshold', type=float, default=0.1,
+                      help='Slowdown over the baseline that fails, 0.1 = 10%%.')
+  parser.add_argument('--list', action='store_true')
+  args = parser.parse_args(argv)
+
+  selected = [(name, setup) for name, setup in BENCHMARKS
+              if not args.filter or any(f in name for f in args.filter)]
+  if args.list:
+    for name, _ in selected:
+      print name
+    return 0
+
+  # Human-readable output goes to stderr when the JSON goes to stdout.
+  out = sys.stderr if args.json == '-' else sys.stdout
+  results = {}
+  for name, setup in selected:
+    seconds = measure(setup, args.min_time, args.repeat)
+    results[name] = {'seconds_per_op': seconds, 'ops_per_second': 1 / seconds}
+    out.write('%-32s %10.3fus/op %12.0f ops/s\n' % (
+        name, seconds * 1e6, 1 / seconds))
+    out.flush()
+
+  if args.json:
+    data = {
+      'python': platform.python_version(),
+      'machine': platform.machine(),
+      'time': time.time(),
+      'results': results,
+    }
+    if args.json == '-':
+      json.dump(data, sys.stdout, indent=2, sort_keys=True)
+    else:
+      with open(args.json, 'w') as f:
+        json.dump(data, f, indent=2, sort_keys=True)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)['results']
+    out.write('\n%-32s %12s %12s %8s\n' % ('', 'baseline', 'now', 'ratio'))
+    if compare(results, baseline, args.threshold, out):
+      return 1
+  return 0
 
 if __name__ == '__main__':
-  benchmark_generic(benchmark_a1, [python_a1, weave_a1])
-  benchmark_generic(benchmark_rgb, [python_rgb, weave_rgb])
+  sys.exit(main(sys.argv[1:]))
@@ -1,8 +1,28 @@
 import collections
+import errno
+import os
 import platform
+import random
+import select
+import threading
+import time
+import traceback
 
-import libusb1
-import usb1
+try:
+  import libusb1
+  import usb1
+except ImportError:
+  libusb1 = usb1 = None  # Only needed by USBTransport.
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+try:
+  from clock import monotonic  # stately/clock.py, when stately is on the path.
+except ImportError:
+  monotonic = getattr(time, 'monotonic', time.time)
 
 G13_KEY_BYTES = collections.namedtuple('G13_KEY_BYTES', [
     'stick_x', 'stick_y', 'keys'])
@@ -10,6 +30,356 @@ G13_KEY_BYTES = collections.namedtuple('G13_KEY_BYTES', [
 class MissingG13Error(Exception):
   """No G13 found on USB."""
 
+class G13TimeoutError(Exception):
+  """No report came in before the read timed out."""
+
+class LCDWriter(threading.Thread):
+  """Sends frames to the LCD from a single long-lived thread.
+
+  submit never touches USB, it only copies the frame into a one-slot mailbox
+  that the thread drains, so only the newest frame is ever sent and at most
+  max_fps frames are sent a second.
+  """
+  def __init__(self, g13, max_fps=30):
+    self.g13 = g13
+    self.interval = 1.0 / max_fps if max_fps else 0
+    self.condition = threading.Condition()
+    self.pending = bytearray(len(g13.pixels))
+    self.has_pending = False
+    self.frame = bytearray(len(g13.pixels))
+    self.last_sent = 0
+    self.stopped = False
+    super(LCDWriter, self).__init__(name='LCDWriter')
+    self.daemon = True
+
+  def submit(self, pixels):
+    with self.condition:
+      self.pending[:] = pixels
+      self.has_pending = True
+      self.condition.notify()
+
+  def run(self):
+    while True:
+      with self.condition:
+        while not self.has_pending and not self.stopped:
+          self.condition.wait()
+        if not self.has_pending:
+          return
+      # Newer frames keep replacing the pending one while we wait. Never wait
+      # more than interval, in case monotonic is time.time and it stepped back.
+      delay = min(self.last_sent + self.interval - monotonic(), self.interval)
+      if delay > 0 and not self.stopped:
+        time.sleep(delay)
+      with self.condition:
+        self.pending, self.frame = self.frame, self.pending
+        self.has_pending = False
+      self.last_sent = monotonic()
+      try:
+        self.g13.write_frame(self.frame)
+      except Exception:
+        # Drop the frame but keep the thread, the next one may get through.
+        traceback.print_exc()
+
+  def stop(self):
+    """Stops the thread once any pending frame is sent."""
+    with self.condition:
+      self.stopped = True
+      self.condition.notify()
+    self.join()
+
+
+class USBTransport(object):
+  """Talks to a real G13 through libusb."""
+  def __init__(self):
+    self.ctx = None
+    self.handle = None
+    self.read_transfers = []
+    self.read_callback = None
+    self.write_transfer = None
+    self.write_callback = None
+
+  def open(self, vendor_id, product_id, interface):
+    self.ctx = usb1.USBContext()
+    dev = self.ctx.getByVendorIDAndProductID(vendor_id, product_id)
+    if not dev:
+      raise MissingG13Error()
+
+    self.interface = interface
+    self.handle = dev.open()
+    if platform.system() == 'Linux' and \
+            self.handle.kernelDriverActive(interface):
+        self.handle.detachKernelDriver(interface)
+
+    self.handle.claimInterface(interface)
+
+    # interruptRead -> R
+    # controlWrite -> Out
+
+  def close(self):
+    self.handle.releaseInterface(self.interface)
+    self.handle.close()
+    self.ctx.exit()
+
+  def interrupt_read(self, endpoint, length, timeout):
+    try:
+      return self.handle.interruptRead(
+          endpoint=endpoint, length=length, timeout=timeout)
+    except libusb1.USBError as e:
+      if e.value == libusb1.LIBUSB_ERROR_TIMEOUT:
+        raise G13TimeoutError()
+      raise
+
+  def interrupt_write(self, endpoint, data, timeout):
+    self.handle.interruptWrite(endpoint=endpoint, data=data, timeout=timeout)
+
+  def control_write(self, request_type, request, value, index, data, timeout):
+    self.handle.controlWrite(
+        request_type=request_type, request=request, value=value, index=index,
+        data=data, timeout=timeout)
+
+  # Asynchronous transfers, completed while handle_events runs.
+  def start_interrupt_reads(self, endpoint, length, callback, count):
+    """Keeps count reads in flight, calling callback(data) as each completes."""
+    self.read_callback = callback
+    self.read_transfers = []
+    for _ in range(count):
+      transfer = self.handle.getTransfer()
+      transfer.setInterrupt(
+          endpoint | libusb1.LIBUSB_ENDPOINT_IN, length,
+          callback=self._read_done, timeout=0)
+      transfer.submit()
+      self.read_transfers.append(transfer)
+
+  def stop_interrupt_reads(self):
+    """Cancels in-flight reads and waits for libusb to release them."""
+    self.read_callback = None
+    for transfer in self.read_transfers:
+      if transfer.isSubmitted():
+        try:
+          transfer.cancel()
+        except libusb1.USBError:
+          pass  # Completed while we were cancelling it.
+    while any(transfer.isSubmitted() for transfer in self.read_transfers):
+      self.ctx.handleEvents()
+    self.read_transfers = []
+
+  @property
+  def reading(self):
+    return self.read_callback is not None
+
+  def _read_done(self, transfer):
+    callback = self.read_callback
+    if callback is None:
+      return  # Stopping, don't resubmit.
+    status = transfer.getStatus()
+    if status not in (usb1.TRANSFER_COMPLETED, usb1.TRANSFER_TIMED_OUT,
+                      usb1.TRANSFER_OVERFLOW):
+      # Cancelled, stalled or the device went away.
+      self.read_callback = None
+      return
+    try:
+      if status == usb1.TRANSFER_COMPLETED:
+        # getBuffer is a view on the transfer's own buffer, so this doesn't
+        # copy until the callback does.
+        callback(
+            memoryview(transfer.getBuffer())[:transfer.getActualLength()])
+    except Exception:
+      # Exceptions can't get out of libusb's callback, and losing the transfer
+      # with them would eventually leave no reads in flight.
+      traceback.print_exc()
+    finally:
+      if self.read_callback is not None:
+        transfer.submit()
+
+  @property
+  def writing(self):
+    return self.write_transfer is not None and self.write_transfer.isSubmitted()
+
+  def interrupt_write_async(self, endpoint, data, callback, timeout):
+    """Starts writing data, which must stay untouched until callback()."""
+    if self.write_transfer is None:
+      self.write_transfer = self.handle.getTransfer()
+    self.write_callback = callback
+    self.write_transfer.setInterrupt(
+        endpoint, data, callback=self._write_done, timeout=timeout)
+    self.write_transfer.submit()
+
+  def _write_done(self, transfer):
+    self.write_callback()
+
+  def handle_events(self, timeout=None):
+    """Runs libusb's event loop once, firing completed transfers' callbacks."""
+    try:
+      if timeout is None:
+        self.ctx.handleEvents()
+      else:
+        self.ctx.handleEventsTimeout(tv=timeout)
+    except usb1.USBErrorInterrupted:
+      pass  # A signal, like SIGUSR1 for stats, interrupted the poll.
+
+  def poll_fds(self):
+    return self.ctx.getPollFDList()
+
+  def interrupt_events(self):
+    """Makes a handle_events blocked on another thread return early."""
+    # Needs libusb 1.0.21, otherwise handle_events waits out its timeout.
+    interrupt = getattr(self.ctx, 'interruptEventHandler', None)
+    if interrupt is not None:
+      interrupt()
+
+
+def _sleep(seconds):
+  # Even time.sleep(0) is a syscall, which would dominate benchmarks.
+  if seconds > 0:
+    time.sleep(seconds)
+
+
+class FakeTransport(object):
+  """Stands in for a G13, for running and profiling without one.
+
+  Reports come from script, an iterable of raw 8-byte reports, or are made up
+  when it's None: the stick wanders and a key changes in about key_rate of
+  them. They're due rate times a second, and reads time out like the real
+  thing when none is due in time, or anyway for about timeout_rate of reads.
+  Every transfer takes latency seconds. Writes are accepted and remembered in
+  lcd_frame, mode_leds and color.
+  """
+  def __init__(self, script=None, rate=125, latency=0, key_rate=0.1,
+               timeout_rate=0, seed=None):
+    self.random = random.Random(seed)
+    if script is None:
+      self.reports = self._random_reports()
+    else:
+      self.reports = iter(script)
+    self.interval = 1.0 / rate
+    self.latency = latency
+    self.key_rate = key_rate
+    self.timeout_rate = timeout_rate
+    self.next_report = None
+    self.next_due = time.time()
+    self.lcd_frame = None
+    self.mode_leds = None
+    self.color = None
+    self.reads = self.writes = 0
+    # For async reads, a thread wakes up handle_events through a pipe when
+    # reports are due, so the pipe can go into an event loop like libusb's.
+    self.read_callback = None
+    self.read_thread = None
+    self.completed = collections.deque()
+    self.wakeup_read, self.wakeup_write = os.pipe()
+
+  def open(self, vendor_id, product_id, interface):
+    pass
+
+  def close(self):
+    self.stop_interrupt_reads()
+    os.close(self.wakeup_read)
+    os.close(self.wakeup_write)
+
+  def _random_reports(self):
+    report = bytearray(8)
+    report[1] = report[2] = 127
+    while True:
+      for i in (1, 2):
+        report[i] = min(255, max(0, report[i] + self.random.randint(-8, 8)))
+      if self.random.random() < self.key_rate:
+        # Only the 39 keys the G13 has, see G13Keys.
+        bit = self.random.randrange(39)
+        report[3 + bit // 8] ^= 1 << (bit % 8)
+      yield bytes(report)
+
+  def _take_report(self):
+    """Returns the next report and when it's due, or (None, None) at the end."""
+    if self.next_report is None:
+      self.next_report = next(self.reports, None)
+      if self.next_report is None:
+        return None, None
+      self.next_due += self.interval
+    return self.next_report, self.next_due
+
+  def interrupt_read(self, endpoint, length, timeout):
+    self.reads += 1
+    report, due = self._take_report()
+    deadline = time.time() + timeout / 1000.0
+    if (report is None or due > deadline or
+        self.random.random() < self.timeout_rate):
+      _sleep(deadline - time.time())
+      raise G13TimeoutError()
+    _sleep(due - time.time() + self.latency)
+    self.next_report = None
+    return report
+
+  def interrupt_write(self, endpoint, data, timeout):
+    _sleep(self.latency)
+    self.writes += 1
+    self.lcd_frame = bytes(data)
+
+  def control_write(self, request_type, request, value, index, data, timeout):
+    _sleep(self.latency)
+    data = bytearray(data)
+    if data[0] == 5:
+      self.mode_leds = data[1]
+    elif data[0] == 7:
+      self.color = tuple(data[1:4])
+
+  def start_interrupt_reads(self, endpoint, length, callback, count):
+    self.read_callback = callback
+    self.read_thread = threading.Thread(target=self._wake_for_reports,
+                                        name='FakeTransport')
+    self.read_thread.daemon = True
+    self.read_thread.start()
+
+  def stop_interrupt_reads(self):
+    self.read_callback = None
+    if self.read_thread is not None:
+      self.read_thread.join()
+      self.read_thread = None
+
+  @property
+  def reading(self):
+    return self.read_callback is not None
+
+  def _wake_for_reports(self):
+    while self.read_callback is not None:
+      report, due = self._take_report()
+      if report is None:
+        self.read_callback = None
+      else:
+        _sleep(due + self.latency - time.time())
+        self.next_report = None
+        self.completed.append((self.read_callback, (report,)))
+      os.write(self.wakeup_write, b'x')
+
+  @property
+  def writing(self):
+    return False
+
+  def interrupt_write_async(self, endpoint, data, callback, timeout):
+    self.interrupt_write(endpoint, data, timeout)
+    self.completed.append((callback, ()))
+    os.write(self.wakeup_write, b'x')
+
+  def handle_events(self, timeout=None):
+    if not self.completed:
+      try:
+        select.select([self.wakeup_read], [], [], timeout)
+      except select.error as e:
+        if e.args[0] != errno.EINTR:
+          raise
+    if select.select([self.wakeup_read], [], [], 0)[0]:
+      os.read(self.wakeup_read, 4096)
+    while self.completed:
+      callback, args = self.completed.popleft()
+      if callback is not None:
+        callback(*args)
+
+  def poll_fds(self):
+    return [(self.wakeup_read, select.POLLIN)]
+
+  def interrupt_events(self):
+    os.write(self.wakeup_write, b'x')
+
+
 class G13(object):
   VENDOR_ID = 0x046d
   PRODUCT_ID = 0xc21c
@@ -18,60 +388,183 @@ class G13(object):
   COLOR_CONTROL = 0x301 # Could be 0x307?
   KEY_ENDPOINT = 1
   REPORT_SIZE = 8
-  REQUEST_TYPE = libusb1.LIBUSB_TYPE_CLASS | libusb1.LIBUSB_RECIPIENT_INTERFACE
+  KEY_TRANSFERS = 4
+  LCD_ENDPOINT = 2
+  REQUEST_TYPE = 0x21  # LIBUSB_TYPE_CLASS | LIBUSB_RECIPIENT_INTERFACE
 
   LCD_WIDTH = 160
   LCD_HEIGHT = 44
+  LCD_HEADER = 32
+  LCD_BANDS = 6  # 8-row bands, the last one only half used.
 
-  def __init__(self):
+  # Same values as cairo's so its constants can be passed straight through.
+  FORMAT_RGB24 = 1
+  FORMAT_A1 = 3
+
+  def __init__(self, transport=None):
+    """transport does the I/O, by default a USBTransport to a real G13."""
+    self.transport = transport if transport is not None else USBTransport()
     # 160 across and 43 down (6 bytes down)
     self.pixels = bytearray(992)
     self.pixels[0] = 3
+    # Reused for every key report, see parse_keys.
+    self.key_report = bytearray(self.REPORT_SIZE)
+    self.key_report_view = memoryview(self.key_report)
+    self.key_bytes = bytearray(self.REPORT_SIZE - 3)
+    self.key_callback = None
+    # Called with every raw key report, e.g. to capture them.
+    self.report_listener = None
+    # Copy of the last frame sent, so unchanged frames aren't resent.
+    self.last_frame = None
+    self.frames_sent = 0
+    self.frames_skipped = 0
+    self.lcd_writer = None
+    self.lcd_buffer = bytearray(len(self.pixels))
+    self.lcd_pending = False
 
   def open(self):
-    self.ctx = usb1.USBContext()
-    dev = self.ctx.getByVendorIDAndProductID(self.VENDOR_ID, self.PRODUCT_ID)
-    if not dev:
-      raise MissingG13Error()
+    self.transport.open(self.VENDOR_ID, self.PRODUCT_ID, self.INTERFACE)
 
-    self.handle = dev.open()
-    if platform.system() == 'Linux' and \
-            self.handle.kernelDriverActive(self.INTERFACE):
-        self.handle.detachKernelDriver(self.INTERFACE)
+  def close(self):
+    self.stop_lcd_writer()
+    self.transport.close()
 
-    self.handle.claimInterface(self.INTERFACE)
+  def get_keys(self, timeout=100):
+    """Waits up to timeout ms for a report, raising G13TimeoutError without."""
+    data = self.transport.interrupt_read(
+        self.KEY_ENDPOINT, self.REPORT_SIZE, timeout=timeout)
+    return self.parse_keys(data)
 
-    # interruptRead -> R
-    # controlWrite -> Out
+  def parse_keys(self, data):
+    """Decodes a raw report into G13_KEY_BYTES.
 
-  def close(self):
-    self.handle.releaseInterface(self.INTERFACE)
-    self.handle.close()
-    self.ctx.exit()
+    The keys bytearray is reused for every report, copy it to keep it past the
+    next one.
+    """
+    report = self.key_report
+    report[:] = data
+    if self.report_listener is not None:
+      self.report_listener(report)
+    report[7] &= ~0x80 # knock out a floating-value key
+    self.key_bytes[:] = self.key_report_view[3:]
+    return G13_KEY_BYTES(report[1], report[2], self.key_bytes)
+
+  # Asynchronous key reports. Instead of polling get_keys, keep a few
+  # interrupt transfers in flight and get called back with each report while
+  # handle_events runs.
+  def start_key_transfers(self, callback, count=KEY_TRANSFERS):
+    """Submits count key transfers, calling callback(keys) for each report."""
+    self.key_callback = callback
+    self.transport.start_interrupt_reads(
+        self.KEY_ENDPOINT, self.REPORT_SIZE, self._report_received, count)
 
-  def get_keys(self):
-    data = self.handle.interruptRead(
-        endpoint=self.KEY_ENDPOINT, length=self.REPORT_SIZE, timeout=100)
-    keys = map(ord, data)
-    keys[7] &= ~0x80 # knock out a floating-value key
-    return G13_KEY_BYTES(keys[1], keys[2], keys[3:])
+  def stop_key_transfers(self):
+    """Cancels in-flight key transfers."""
+    self.key_callback = None
+    self.transport.stop_interrupt_reads()
+
+  @property
+  def listening(self):
+    return self.transport.reading
+
+  def _report_received(self, data):
+    if self.key_callback is not None:
+      self.key_callback(self.parse_keys(data))
+
+  def handle_events(self, timeout=None):
+    """Waits for and runs callbacks of completed transfers."""
+    self.transport.handle_events(timeout)
+
+  def poll_fds(self):
+    """Returns (fd, events) to watch when running another event loop.
+
+    events are select.POLLIN/POLLOUT flags, call handle_events(0) when any of
+    them is ready.
+    """
+    return self.transport.poll_fds()
+
+  def interrupt_events(self):
+    """Wakes up handle_events from another thread, e.g. to run commands."""
+    self.transport.interrupt_events()
 
   def set_mode_leds(self, mode):
     data = ''.join(map(chr, [5, mode, 0, 0, 0]))
-    self.handle.controlWrite(
+    self.transport.control_write(
         request_type=self.REQUEST_TYPE, request=9,
         value=self.MODE_LED_CONTROL, index=0, data=data,
         timeout=1000)
 
   def set_color(self, color):
     data = ''.join(map(chr, [7, color[0], color[1], color[2], 0]))
-    self.handle.controlWrite(
+    self.transport.control_write(
         request_type=self.REQUEST_TYPE, request=9,
         value=self.COLOR_CONTROL, index=0, data=data,
         timeout=1000)
 
-  def write_lcd(self):
-    self.handle.interruptWrite(endpoint=2, data=str(self.pixels), timeout=1000)
+  def write_lcd(self, force=False):
+    """Sends pixels to the LCD unless it's identical to the last frame sent.
+
+    Returns whether the frame was sent. Blocks on USB, see write_lcd_bg.
+    """
+    return self.write_frame(self.pixels, force)
+
+  def write_frame(self, frame, force=False):
+    if not force and frame == self.last_frame:
+      self.frames_skipped += 1
+      return False
+    # Pass the bytearray itself, str() would copy the whole frame each time.
+    self.transport.interrupt_write(self.LCD_ENDPOINT, frame, timeout=1000)
+    self._frame_sent(frame)
+    return True
+
+  def _frame_sent(self, frame):
+    if self.last_frame is None or len(self.last_frame) != len(frame):
+      self.last_frame = bytearray(frame)
+    else:
+      self.last_frame[:] = frame
+    self.frames_sent += 1
+
+  def write_lcd_async(self, force=False):
+    """Like write_lcd, but sends pixels with an async transfer.
+
+    The transfer completes while handle_events runs. If a frame is still being
+    sent, pixels is sent once it completes, so only the newest frame queues up.
+    """
+    if self.transport.writing:
+      self.lcd_pending = True
+      return
+    self._submit_lcd(force)
+
+  def _submit_lcd(self, force=False):
+    self.lcd_pending = False
+    if not force and self.pixels == self.last_frame:
+      self.frames_skipped += 1
+      return
+    self.lcd_buffer[:] = self.pixels
+    self.transport.interrupt_write_async(
+        self.LCD_ENDPOINT, self.lcd_buffer, self._lcd_transfer_done,
+        timeout=1000)
+    self._frame_sent(self.lcd_buffer)
+
+  def _lcd_transfer_done(self):
+    if self.lcd_pending:
+      self._submit_lcd()
+
+  def start_lcd_writer(self, max_fps=30):
+    if self.lcd_writer is None:
+      self.lcd_writer = LCDWriter(self, max_fps)
+      self.lcd_writer.start()
+
+  def stop_lcd_writer(self):
+    if self.lcd_writer is not None:
+      self.lcd_writer.stop()
+      self.lcd_writer = None
+
+  def write_lcd_bg(self):
+    """Queues a copy of pixels for the LCD writer thread without blocking."""
+    if self.lcd_writer is None:
+      self.start_lcd_writer()
+    self.lcd_writer.submit(self.pixels)
 
   def set_pixel(self, x, y, val):
     x = min(x, 159)
@@ -82,3 +575,56 @@ class G13(object):
     else:
       self.pixels[idx] &= ~(1 << (y%8))
 
+
+  def blit_surface(self, buffer, fmt, stride=None, threshold=128):
+    """Packs a whole 160x44 frame into pixels.
+
+    buffer is the raw data of a cairo surface (or anything exposing the same
+    layout) in FORMAT_RGB24 or FORMAT_A1. RGB24 pixels are lit when any channel
+    is above threshold, A1 pixels when their bit is set.
+    """
+    if numpy is None:
+      return self._blit_surface_slow(buffer, fmt, stride, threshold)
+
+    width, height = self.LCD_WIDTH, self.LCD_HEIGHT
+    if fmt == self.FORMAT_RGB24:
+      stride = stride or width * 4
+      source = numpy.frombuffer(buffer, dtype=numpy.uint32, count=height *
+                                stride // 4).reshape(height, stride // 4)
+      source = source[:, :width]
+      lit = (((source >> 16) & 0xff) > threshold) | \
+            (((source >> 8) & 0xff) > threshold) | \
+            ((source & 0xff) > threshold)
+    elif fmt == self.FORMAT_A1:
+      stride = stride or (width + 31) // 32 * 4
+      source = numpy.frombuffer(buffer, dtype=numpy.uint8,
+                                count=height * stride).reshape(height, stride)
+      # cairo's A1 is least significant bit first, unpackbits is the opposite.
+      lit = numpy.unpackbits(source, axis=1).reshape(height, stride, 8)
+      lit = lit[:, :, ::-1].reshape(height, stride * 8)[:, :width]
+    else:
+      raise ValueError('Unsupported surface format: %r' % (fmt,))
+
+    bands = numpy.zeros((self.LCD_BANDS * 8, width), dtype=numpy.uint8)
+    bands[:height] = lit
+    # Row 0 of each band is bit 0, packbits wants it last.
+    bands = bands.reshape(self.LCD_BANDS, 8, width)[:, ::-1, :]
+    dest = numpy.frombuffer(self.pixels, dtype=numpy.uint8,
+                            count=self.LCD_BANDS * width,
+                            offset=self.LCD_HEADER)
+    dest[:] = numpy.packbits(bands, axis=1).ravel()
+
+  def _blit_surface_slow(self, buffer, fmt, stride, threshold):
+    width, height = self.LCD_WIDTH, self.LCD_HEIGHT
+    buffer = bytearray(buffer)
+    for y in xrange(height):
+      for x in xrange(width):
+        if fmt == self.FORMAT_RGB24:
+          offset = y * (stride or width * 4) + x * 4
+          val = max(buffer[offset:offset + 3]) > threshold
+        elif fmt == self.FORMAT_A1:
+          byte = buffer[y * (stride or (width + 31) // 32 * 4) + x // 8]
+          val = byte & (1 << (x % 8))
+        else:
+          raise ValueError('Unsupported surface format: %r' % (fmt,))
+        self.set_pixel(x, y, val)
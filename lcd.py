@@ -0,0 +1,285 @@
+"""Drawing straight into a G13's packed LCD framebuffer.
+
+G13.pixels holds the LCD after a LCD_HEADER byte header as LCD_BANDS bands of 8
+rows, one byte per column in each with the band's top row in bit 0. Rather than
+rendering a whole frame with cairo and converting it with blit_surface, things
+drawn often are packed into that layout once and copied in.
+
+BitmapFont rasterizes each glyph once per font and size. Drawing a string is
+then a slice copy per glyph and band, with only the rows a band shares with
+whatever is above or below the text merged byte by byte. ImageCache does the
+same for PNGs, keeping the most recently drawn ones packed within a memory
+budget.
+"""
+import collections
+import math
+
+try:
+  import cairo
+except ImportError:
+  cairo = None  # Only needed to rasterize fonts and images.
+
+from g13 import G13
+
+
+def blit_columns(pixels, x, y, columns, height, cache=None):
+  """Draws columns, each an int with a bit per row, top row in bit 0.
+
+  The height rows of each column are replaced, clipped to the LCD. cache, a
+  dict, keeps the columns packed for each y % 8 they're drawn at.
+  """
+  shift = y % 8
+  packed = cache.get(shift) if cache is not None else None
+  if packed is None:
+    packed = pack_columns(columns, height, shift)
+    if cache is not None:
+      cache[shift] = packed
+  width = len(columns)
+  start = max(0, -x)
+  end = min(width, G13.LCD_WIDTH - x)
+  if start >= end:
+    return
+  first_band = y // 8
+  for band, data, mask in packed:
+    band += first_band
+    if band < 0:
+      continue
+    if band >= G13.LCD_BANDS:
+      break
+    offset = G13.LCD_HEADER + band * G13.LCD_WIDTH + x
+    if mask == 0xff:
+      pixels[offset + start:offset + end] = (
+          data if start == 0 and end == width else data[start:end])
+    else:
+      keep = ~mask
+      for i in xrange(start, end):
+        pixels[offset + i] = pixels[offset + i] & keep | data[i]
+
+def pack_columns(columns, height, shift=0):
+  """Returns (band, bytes, mask) for each band columns cover shift rows down.
+
+  mask has the bits of the band's rows that columns cover.
+  """
+  rows = (1 << height) - 1
+  packed = []
+  for band in xrange((shift + height + 7) // 8):
+    down = band * 8
+    data = bytearray((column << shift >> down) & 0xff for column in columns)
+    packed.append((band, data, (rows << shift >> down) & 0xff))
+  return packed
+
+
+class Bitmap(object):
+  """A packed 1-bit image, like a glyph or an icon."""
+  __slots__ = ('columns', 'width', 'height', 'packed')
+
+  def __init__(self, columns, height):
+    self.columns = columns
+    self.width = len(columns)
+    self.height = height
+    # y % 8 to pack_columns' result.
+    self.packed = {}
+
+  def draw(self, pixels, x, y):
+    blit_columns(pixels, x, y, self.columns, self.height, self.packed)
+
+  @property
+  def size(self):
+    """Roughly the bytes it takes, for cache budgets."""
+    return self.width * ((self.height + 7) // 8) * (1 + len(self.packed))
+
+Glyph = Bitmap
+
+
+class BitmapFont(object):
+  """A cairo font rasterized for the LCD, one glyph at a time as needed.
+
+  Pixels are lit when any channel is above threshold, like blit_surface. Use
+  BitmapFont.get to share fonts, and their glyphs, between users.
+  """
+  fonts = {}
+
+  @classmethod
+  def get(cls, face, size, threshold=128):
+    key = face, size, threshold
+    font = cls.fonts.get(key)
+    if font is None:
+      font = cls.fonts[key] = cls(face, size, threshold)
+    return font
+
+  def __init__(self, face, size, threshold=128):
+    if cairo is None:
+      raise ImportError('BitmapFont needs pycairo to rasterize fonts.')
+    self.face = face
+    self.size = size
+    self.threshold = threshold
+    self.glyphs = {}
+    self.context = self._context(cairo.ImageSurface(cairo.FORMAT_RGB24, 1, 1))
+    ascent, descent = self.context.font_extents()[:2]
+    self.ascent = int(math.ceil(ascent))
+    self.height = self.ascent + int(math.ceil(descent))
+
+  def _context(self, surface):
+    context = cairo.Context(surface)
+    context.set_source_rgb(1, 1, 1)
+    context.select_font_face(self.face)
+    context.set_font_size(self.size)
+    return context
+
+  def glyph(self, char):
+    glyph = self.glyphs.get(char)
+    if glyph is None:
+      glyph = self.glyphs[char] = self._rasterize(char)
+    return glyph
+
+  def _rasterize(self, char):
+    width = max(1, int(round(self.context.text_extents(char)[4])))
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, self.height)
+    context = self._context(surface)
+    context.move_to(0, self.ascent)
+    context.show_text(char)
+    surface.flush()
+    data = bytearray(surface.get_data())
+    stride = surface.get_stride()
+    columns = []
+    for x in xrange(width):
+      column = 0
+      for y in xrange(self.height):
+        offset = y * stride + x * 4
+        if max(data[offset:offset + 3]) > self.threshold:
+          column |= 1 << y
+      columns.append(column)
+    return Bitmap(columns, self.height)
+
+  def measure(self, text):
+    return sum(self.glyph(char).width for char in text)
+
+  def draw(self, g13, text, x=0, y=0, clear_to=None):
+    """Draws text into g13.pixels with its top left corner at x, y.
+
+    Each glyph's whole box is drawn, so text replaces what was under it. Pass
+    clear_to to also blank the line up to that x, e.g. where the last, longer,
+    text drawn there ended. Returns the x text ended at.
+    """
+    pixels = g13.pixels
+    for char in text:
+      glyph = self.glyph(char)
+      glyph.draw(pixels, x, y)
+      x += glyph.width
+    if clear_to is not None and clear_to > x:
+      blit_columns(pixels, x, y, [0] * (clear_to - x), self.height)
+    return x
+
+
+# 4x4 ordered dither thresholds, in 16ths.
+BAYER = ((0, 8, 2, 10), (12, 4, 14, 6), (3, 11, 1, 9), (15, 7, 13, 5))
+
+class ImageCache(object):
+  """Draws PNGs from packed bitmaps, keeping the most recently used ones.
+
+  Images are drawn like cairo would paint them onto the LCD, scaled by scale
+  with offset in scaled coordinates, replacing the rectangle they cover.
+  Pixels are lit when any channel is above threshold, or with dither='ordered'
+  when their brightness beats a 4x4 Bayer matrix. Each combination of those is
+  packed once and kept until over max_bytes of others are used after it.
+  """
+  DITHER_MODES = (None, 'ordered')
+
+  def __init__(self, max_bytes=256 * 1024):
+    self.max_bytes = max_bytes
+    self.used_bytes = 0
+    # Key to (x, y, Bitmap), least recently used first.
+    self.entries = collections.OrderedDict()
+    self.hits = self.misses = 0
+
+  def get(self, path, scale=1, offset=(0, 0), threshold=128, dither=None):
+    """Returns (x, y, Bitmap) for where and what to draw."""
+    key = path, scale, tuple(offset), threshold, dither
+    entry = self.entries.pop(key, None)
+    if entry is None:
+      self.misses += 1
+      x, y, bitmap = self._load(path, scale, offset, threshold, dither)
+      return self.put(path, x, y, bitmap, scale, offset, threshold, dither)
+    self.hits += 1
+    self.entries[key] = entry
+    return entry
+
+  def put(self, path, x, y, bitmap, scale=1, offset=(0, 0), threshold=128,
+          dither=None):
+    """Caches bitmap, drawn at x, y, as the image for the other arguments.
+
+    Returns (x, y, bitmap). Evicts the least recently used images that don't
+    fit in max_bytes along with it.
+    """
+    key = path, scale, tuple(offset), threshold, dither
+    old = self.entries.pop(key, None)
+    if old is not None:
+      self.used_bytes -= old[2].size
+    entry = self.entries[key] = x, y, bitmap
+    self.used_bytes += bitmap.size
+    while self.used_bytes > self.max_bytes and len(self.entries) > 1:
+      _, (_, _, evicted) = self.entries.popitem(last=False)
+      self.used_bytes -= evicted.size
+    return entry
+
+  def draw(self, g13, path, scale=1, offset=(0, 0), threshold=128,
+           dither=None):
+    """Draws an image into g13.pixels, loading it if it isn't cached."""
+    x, y, bitmap = self.get(path, scale, offset, threshold, dither)
+    bitmap.draw(g13.pixels, x, y)
+
+  def clear(self):
+    self.entries.clear()
+    self.used_bytes = 0
+
+  def _load(self, path, scale, offset, threshold, dither):
+    if cairo is None:
+      raise ImportError('ImageCache needs pycairo to load images.')
+    if dither not in self.DITHER_MODES:
+      raise ValueError('Unknown dither mode: %r' % (dither,))
+    image = cairo.ImageSurface.create_from_png(path)
+    left = int(math.floor(offset[0] * scale))
+    top = int(math.floor(offset[1] * scale))
+    right = int(math.ceil((offset[0] + image.get_width()) * scale))
+    bottom = int(math.ceil((offset[1] + image.get_height()) * scale))
+    left, top = max(0, left), max(0, top)
+    right = min(G13.LCD_WIDTH, right)
+    bottom = min(G13.LCD_HEIGHT, bottom)
+    if right <= left or bottom <= top:
+      return 0, 0, Bitmap([], 0)
+
+    width, height = right - left, bottom - top
+    surface = cairo.ImageSurface(cairo.FORMAT_RGB24, width, height)
+    context = cairo.Context(surface)
+    context.translate(-left, -top)
+    context.scale(scale, scale)
+    context.set_source_surface(image, *offset)
+    context.paint()
+    surface.flush()
+    data = bytearray(surface.get_data())
+    stride = surface.get_stride()
+
+    columns = []
+    for x in xrange(width):
+      column = 0
+      for y in xrange(height):
+        i = y * stride + x * 4
+        if dither is None:
+          lit = max(data[i:i + 3]) > threshold
+        else:
+          blue, green, red = data[i:i + 3]
+          brightness = (red * 299 + green * 587 + blue * 114) // 1000
+          # Lit above (cell + 0.5) / 8 of threshold, so 128 spreads the cells
+          # evenly over 0-255.
+          lit = brightness * 16 > (BAYER[y % 4][x % 4] * 2 + 1) * threshold
+        if lit:
+          column |= 1 << y
+      columns.append(column)
+    if top == 0 and height == G13.LCD_HEIGHT:
+      # The rows under the LCD are never shown, but covering them makes each
+      # band a whole byte copy.
+      height = G13.LCD_BANDS * 8
+    bitmap = Bitmap(columns, height)
+    # It's only ever drawn here, so pack it now and count that in its size.
+    bitmap.packed[top % 8] = pack_columns(columns, height, top % 8)
+    return left, top, bitmap
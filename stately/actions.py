@@ -1,94 +1,464 @@
 """Action helper for plugins to use.
 
 ActionHelper handles plugins' requested actions, such as listening to window
-titles, pressing/releasing/tapping keys, and mouse actions.
+titles, pressing/releasing/tapping keys, and mouse actions. The keys and mouse
+actions go to a backend from BACKENDS: autopy (the default) or uinput to
+inject them, null to drop them and recording to keep them in a ring buffer, for
+timing and testing dispatch without a desktop session.
 
 WindowWatcher and its platform-specific subclasses, for which it's replaced on
-instantiation via __new__, does the actual window title watching.
+instantiation via __new__, does the actual window title watching. On Linux,
+X11WindowWatcher is used when python-xlib is installed, otherwise it falls back
+to polling xdotool.
 """
+import collections
 import platform
+import re
+import sre_constants
+import sre_parse
+import string
 import threading
 import time
 
-import autopy
+from clock import monotonic
+
+try:
+  import evdev
+  from evdev import ecodes
+except ImportError:
+  evdev = None  # Only needed for UinputBackend.
 
 if platform.system() == 'Windows':
   import win32gui
 elif platform.system() == 'Linux':
+  import select
   import subprocess
+  try:
+    import Xlib.display
+    import Xlib.error
+    import Xlib.X
+    import Xlib.Xatom
+  except ImportError:
+    Xlib = None
 
 
 class ActionHelper(object):
-  def __init__(self):
+  def __init__(self, backend='autopy'):
+    """backend is a name from BACKENDS or an object with the same methods."""
+    if isinstance(backend, basestring):
+      backend = BACKENDS[backend]()
+    self.backend = backend
     self.window_registration = {}
+    self.window_matcher = WindowTitleMatcher()
+    # Listeners already given a chance at window_title, see window_changed.
+    self.window_title = None
+    self.window_notified = set()
+    # A latency.LatencyTracker to tell when actions are injected.
+    self.latency = None
 
   # Window title functions
   def register_window_listener(self, filter_func, activate_cb):
     self.window_registration[filter_func] = activate_cb
   def unregister_window_listener(self, filter_func):
     del self.window_registration[filter_func]
-  def start_window_listener(self, state_obj):
-    self.window_watcher = WindowWatcher(self.window_registration, state_obj)
-    self.window_watcher.start()
+    self.window_notified.discard(filter_func)
+  def register_window_match(self, activate_cb, suffix=None, prefix=None,
+                            regex=None):
+    """Calls activate_cb when the title has the suffix/prefix or matches regex.
+
+    regex can't use backreferences, see WindowTitleMatcher. Returns an id to
+    pass to unregister_window_match.
+    """
+    return self.window_matcher.add(activate_cb, suffix, prefix, regex)
+  def unregister_window_match(self, match_id):
+    self.window_matcher.remove(match_id)
+    self.window_notified.discard(match_id)
+  @property
+  def has_window_listeners(self):
+    return bool(self.window_registration or self.window_matcher.rules)
+  def start_window_listener(self, state_obj, loop=None):
+    """Starts watching window titles, delivering them on loop if given."""
+    self.window_watcher = WindowWatcher(self, state_obj)
+    self.window_watcher.start(loop)
   def stop_window_listener(self):
     self.window_watcher.stop()
+  def window_changed(self, state_obj, title):
+    """Called on the dispatch thread with the active window's title.
+
+    Listeners are only called once per title, and only listeners registered
+    since the last call are checked when the title hasn't changed.
+    """
+    if title != self.window_title:
+      self.window_title = title
+      self.window_notified = set()
+    notified = self.window_notified
+    for match_id, activate_cb in self.window_matcher.match(title):
+      if match_id not in notified:
+        notified.add(match_id)
+        activate_cb(state_obj, title)
+    for filter_func, activate_cb in self.window_registration.items():
+      if filter_func not in notified:
+        notified.add(filter_func)
+        if filter_func(title):
+          activate_cb(state_obj, title)
 
+  # Each notifies latency once the action has been injected.
   def press_key(self, key, modifiers=0):
-    autopy.key.toggle(key, True, modifiers)
+    self.backend.press_key(key, modifiers)
+    if self.latency is not None:
+      self.latency.injected()
   def release_key(self, key, modifiers=0):
-    autopy.key.toggle(key, False, modifiers)
+    self.backend.release_key(key, modifiers)
+    if self.latency is not None:
+      self.latency.injected()
   def tap_key(self, key, modifiers=0):
-    autopy.key.tap(key, modifiers)
+    self.backend.tap_key(key, modifiers)
+    if self.latency is not None:
+      self.latency.injected()
   # Mouse functions
   def mouse_relative(self, x, y):
-    mx, my = autopy.mouse.get_pos()
-    try:
-      autopy.mouse.move(mx + x, my + y)
-    except ValueError:
-      pass
+    self.backend.mouse_relative(x, y)
+    if self.latency is not None:
+      self.latency.injected()
   def mouse_toggle(self, down, button):
-    autopy.mouse.toggle(down, button)
+    self.backend.mouse_toggle(down, button)
+    if self.latency is not None:
+      self.latency.injected()
+
   # Platform-specific functions
   def get_active_window_title(self):
     return self.window_watcher.get_active_window_title()
 
-# Constants pulled in from autopy for now, we reserve the right to change their
-# values, so always pull them from the state object's action instance. To make
-# sure, some of the attribute names don't match autopy's. :P
-for attr in dir(autopy.key) + dir(autopy.mouse):
-  if attr.startswith('MOD_'):
-    setattr(ActionHelper, attr, getattr(autopy.key, attr))
-  elif attr.startswith('K_'):
-    setattr(ActionHelper, 'KEY_' + (attr[2:]), getattr(autopy.key, attr))
-  elif attr.endswith('_BUTTON'):
-    setattr(ActionHelper,
-            'MOUSE_' + attr.split('_')[0],
-            getattr(autopy.mouse, attr))
+# Key, modifier and mouse button constants, named after autopy's, which
+# backends translate to whatever they inject. Always pull them from the state
+# object's action instance. Characters are keys as they are.
+MODIFIER_NAMES = ('META', 'ALT', 'CONTROL', 'SHIFT')
+KEY_NAMES = (
+    'BACKSPACE', 'DELETE', 'RETURN', 'ESCAPE', 'UP', 'DOWN', 'RIGHT', 'LEFT',
+    'HOME', 'END', 'PAGEUP', 'PAGEDOWN', 'META', 'ALT', 'CONTROL', 'SHIFT',
+    'CAPSLOCK') + tuple('F%d' % i for i in range(1, 13))
+BUTTON_NAMES = ('LEFT', 'RIGHT', 'CENTER')
+
+ActionHelper.MOD_NONE = 0
+for i, name in enumerate(MODIFIER_NAMES):
+  setattr(ActionHelper, 'MOD_' + name, 1 << i)
+for i, name in enumerate(KEY_NAMES):
+  setattr(ActionHelper, 'KEY_' + name, i + 1)
+for i, name in enumerate(BUTTON_NAMES):
+  setattr(ActionHelper, 'MOUSE_' + name, i + 1)
+
+
+class AutopyBackend(object):
+  """Injects keys and mouse events through autopy, imported once it's used."""
+  def __init__(self):
+    import autopy
+    self.autopy = autopy
+    self.keys = {
+        getattr(ActionHelper, 'KEY_' + name): getattr(autopy.key, 'K_' + name)
+        for name in KEY_NAMES if hasattr(autopy.key, 'K_' + name)}
+    self.modifiers = [
+        (getattr(ActionHelper, 'MOD_' + name),
+         getattr(autopy.key, 'MOD_' + name))
+        for name in MODIFIER_NAMES if hasattr(autopy.key, 'MOD_' + name)]
+    self.buttons = {
+        getattr(ActionHelper, 'MOUSE_' + name):
+            getattr(autopy.mouse, name + '_BUTTON')
+        for name in BUTTON_NAMES if hasattr(autopy.mouse, name + '_BUTTON')}
+
+  def _modifiers(self, modifiers):
+    flags = 0
+    for mod, autopy_mod in self.modifiers:
+      if modifiers & mod:
+        flags |= autopy_mod
+    return flags
+
+  def press_key(self, key, modifiers):
+    self.autopy.key.toggle(
+        self.keys.get(key, key), True, self._modifiers(modifiers))
+  def release_key(self, key, modifiers):
+    self.autopy.key.toggle(
+        self.keys.get(key, key), False, self._modifiers(modifiers))
+  def tap_key(self, key, modifiers):
+    self.autopy.key.tap(self.keys.get(key, key), self._modifiers(modifiers))
+  def mouse_relative(self, x, y):
+    mx, my = self.autopy.mouse.get_pos()
+    try:
+      self.autopy.mouse.move(mx + x, my + y)
+    except ValueError:
+      pass
+  def mouse_toggle(self, down, button):
+    self.autopy.mouse.toggle(down, self.buttons[button])
+
+class UinputBackend(object):
+  """Injects events into a virtual input device through Linux's uinput.
+
+  Needs python-evdev and write access to /dev/uinput. Each action is written
+  as a single batch of events ending in one SYN_REPORT, and mouse motion is
+  relative so there's no round trip to the X server.
+  """
+  CHAR_KEYS = {
+    '\t': 'TAB', '\n': 'ENTER', ' ': 'SPACE', '-': 'MINUS', '=': 'EQUAL',
+    '[': 'LEFTBRACE', ']': 'RIGHTBRACE', ';': 'SEMICOLON',
+    "'": 'APOSTROPHE', '`': 'GRAVE', '\\': 'BACKSLASH', ',': 'COMMA',
+    '.': 'DOT', '/': 'SLASH',
+  }
+  # KEY_NAMES that evdev names differently.
+  SPECIAL_KEYS = {
+    'RETURN': 'ENTER', 'ESCAPE': 'ESC', 'META': 'LEFTMETA', 'ALT': 'LEFTALT',
+    'CONTROL': 'LEFTCTRL', 'SHIFT': 'LEFTSHIFT',
+  }
+  MODIFIERS = (
+    ('MOD_META', 'KEY_LEFTMETA'),
+    ('MOD_ALT', 'KEY_LEFTALT'),
+    ('MOD_CONTROL', 'KEY_LEFTCTRL'),
+    ('MOD_SHIFT', 'KEY_LEFTSHIFT'),
+  )
+  BUTTONS = {
+    'MOUSE_LEFT': 'BTN_LEFT',
+    'MOUSE_RIGHT': 'BTN_RIGHT',
+    'MOUSE_CENTER': 'BTN_MIDDLE',
+  }
+
+  def __init__(self, name='stately'):
+    if evdev is None:
+      raise ImportError('UinputBackend needs python-evdev.')
+    codes = ecodes.ecodes
+    self.keys = {}
+    for char, key_name in self.CHAR_KEYS.items():
+      self.keys[char] = codes['KEY_' + key_name]
+    for char in string.ascii_lowercase + string.digits:
+      self.keys[char] = codes['KEY_' + char.upper()]
+    for key_name in KEY_NAMES:
+      evdev_name = 'KEY_' + self.SPECIAL_KEYS.get(key_name, key_name)
+      if evdev_name in codes:
+        self.keys[getattr(ActionHelper, 'KEY_' + key_name)] = codes[evdev_name]
+    self.modifiers = [(getattr(ActionHelper, mod), codes[mod_code])
+                      for mod, mod_code in self.MODIFIERS]
+    self.buttons = {
+        getattr(ActionHelper, attr): codes[button_code]
+        for attr, button_code in self.BUTTONS.items()}
+    self.shift = codes['KEY_LEFTSHIFT']
+    key_codes = set(self.keys.values()) | set(self.buttons.values())
+    key_codes.update(code for _, code in self.modifiers)
+    self.device = evdev.UInput({
+        ecodes.EV_KEY: sorted(key_codes),
+        ecodes.EV_REL: [ecodes.REL_X, ecodes.REL_Y],
+    }, name=name)
+
+  def _key_codes(self, key, modifiers):
+    """Returns the modifier codes and the key code to send for key."""
+    held = [code for mod, code in self.modifiers if modifiers & mod]
+    code = self.keys.get(key)
+    if code is None and isinstance(key, basestring) and key.isupper():
+      code = self.keys.get(key.lower())
+      held.append(self.shift)
+    if code is None:
+      raise ValueError('No uinput key code for %r' % (key,))
+    return held, code
+
+  def _write_keys(self, codes, value):
+    for code in codes:
+      self.device.write(ecodes.EV_KEY, code, value)
+
+  def press_key(self, key, modifiers):
+    held, code = self._key_codes(key, modifiers)
+    self._write_keys(held + [code], 1)
+    self.device.syn()
+  def release_key(self, key, modifiers):
+    held, code = self._key_codes(key, modifiers)
+    self._write_keys([code] + held[::-1], 0)
+    self.device.syn()
+  def tap_key(self, key, modifiers):
+    self.press_key(key, modifiers)
+    self.release_key(key, modifiers)
+  def mouse_relative(self, x, y):
+    if x:
+      self.device.write(ecodes.EV_REL, ecodes.REL_X, x)
+    if y:
+      self.device.write(ecodes.EV_REL, ecodes.REL_Y, y)
+    if x or y:
+      self.device.syn()
+  def mouse_toggle(self, down, button):
+    self.device.write(ecodes.EV_KEY, self.buttons[button], int(bool(down)))
+    self.device.syn()
+  def close(self):
+    self.device.close()
+
+class NullBackend(object):
+  """Drops every action, to time dispatch without the cost of injecting."""
+  def press_key(self, key, modifiers):
+    pass
+  def release_key(self, key, modifiers):
+    pass
+  def tap_key(self, key, modifiers):
+    pass
+  def mouse_relative(self, x, y):
+    pass
+  def mouse_toggle(self, down, button):
+    pass
+
+class RecordingBackend(object):
+  """Keeps the last size actions instead of injecting them.
+
+  events holds (monotonic time, action name, args) tuples, oldest first, and
+  count how many actions there have been in all, dropped ones included.
+  """
+  def __init__(self, size=4096):
+    self.events = collections.deque(maxlen=size)
+    self.count = 0
+
+  def _record(self, action, *args):
+    self.events.append((monotonic(), action, args))
+    self.count += 1
+
+  def clear(self):
+    self.events.clear()
+    self.count = 0
+
+  def press_key(self, key, modifiers):
+    self._record('press_key', key, modifiers)
+  def release_key(self, key, modifiers):
+    self._record('release_key', key, modifiers)
+  def tap_key(self, key, modifiers):
+    self._record('tap_key', key, modifiers)
+  def mouse_relative(self, x, y):
+    self._record('mouse_relative', x, y)
+  def mouse_toggle(self, down, button):
+    self._record('mouse_toggle', down, button)
+
+BACKENDS = {
+  'autopy': AutopyBackend,
+  'uinput': UinputBackend,
+  'null': NullBackend,
+  'recording': RecordingBackend,
+}
+
+
+class WindowTitleMatcher(object):
+  """Matches window titles against suffix, prefix and regex rules.
+
+  All rules are compiled into one regex with an optional lookahead per rule,
+  so a title is checked against every rule in a single match, and the result
+  is cached per title until the rules change. That renumbers regex rules'
+  groups, so they can't use backreferences.
+  """
+  CACHE_SIZE = 256
+
+  def __init__(self):
+    self.rules = {}
+    self.next_id = 0
+    self.compiled = None, (), {}
+
+  def add(self, activate_cb, suffix=None, prefix=None, regex=None):
+    if [suffix, prefix, regex].count(None) != 2:
+      raise ValueError('Exactly one of suffix, prefix and regex is needed.')
+    if suffix is not None:
+      pattern = '.*' + re.escape(suffix) + r'\Z'
+    elif prefix is not None:
+      pattern = re.escape(prefix)
+    else:
+      # Raises re.error before any rule is touched.
+      if _has_backreference(sre_parse.parse(regex)):
+        raise ValueError('Window title regexes cannot use backreferences: %r'
+                         % regex)
+      pattern = '.*?(?:%s)' % regex
+    match_id = self.next_id
+    self.next_id += 1
+    self.rules[match_id] = pattern, activate_cb
+    try:
+      self._compile()
+    except re.error:
+      del self.rules[match_id]
+      raise
+    return match_id
+
+  def remove(self, match_id):
+    del self.rules[match_id]
+    self._compile()
+
+  def _compile(self):
+    rules = sorted(self.rules.items())
+    if not rules:
+      self.compiled = None, (), {}
+      return
+    regex = re.compile(''.join(
+        '(?:(?=(?P<m%d>%s)))?' % (match_id, pattern)
+        for match_id, (pattern, _) in rules), re.DOTALL)
+    callbacks = tuple(
+        ('m%d' % match_id, (match_id, activate_cb))
+        for match_id, (_, activate_cb) in rules)
+    # Swapped in all at once, so match never sees them out of step.
+    self.compiled = regex, callbacks, {}
+
+  def match(self, title):
+    """Returns (match_id, activate_cb) for each rule matching title."""
+    regex, callbacks, cache = self.compiled
+    matched = cache.get(title)
+    if matched is None:
+      if regex is None:
+        return ()
+      if len(cache) >= self.CACHE_SIZE:
+        cache.clear()
+      groups = regex.match(title).groupdict()
+      matched = tuple(callback for group, callback in callbacks
+                      if groups[group] is not None)
+      cache[title] = matched
+    return matched
+
+def _has_backreference(parsed):
+  """Returns whether an sre_parse result refers back to one of its groups."""
+  for item in parsed:
+    if isinstance(item, sre_parse.SubPattern):
+      if _has_backreference(item):
+        return True
+    elif isinstance(item, (list, tuple)):
+      if item and item[0] in (sre_constants.GROUPREF,
+                              sre_constants.GROUPREF_EXISTS):
+        return True
+      if _has_backreference(item):
+        return True
+  return False
 
 
 class WindowWatcher(threading.Thread):
+  # Seconds between checks for watchers that have to poll.
+  POLL_INTERVAL = 0.2
+
   def __new__(cls, *args):
     if platform.system() == 'Windows':
       cls = WindowsWindowWatcher
     elif platform.system() == 'Linux':
-      cls = LinuxWindowWatcher
+      if Xlib is not None and X11WindowWatcher.can_connect():
+        cls = X11WindowWatcher
+      else:
+        # Headless or Wayland, xdotool just finds no titles there.
+        cls = LinuxWindowWatcher
     return object.__new__(cls, *args)
 
-  def __init__(self, registration, state_obj):
-    self.registration = registration
+  def __init__(self, action_helper, state_obj):
+    self.action_helper = action_helper
     self.state_obj = state_obj
     self.stopped = False
     super(WindowWatcher, self).__init__()
+    self.daemon = True
+
+  def start(self, loop=None):
+    """Starts the watcher thread, watchers that can may use loop instead."""
+    super(WindowWatcher, self).start()
 
   def run(self):
     while not self.stopped:
-      if not self.registration:
+      if not self.action_helper.has_window_listeners:
         time.sleep(1)
         continue
-      title = self.get_active_window_title()
-      for filter_func, activate_cb in self.registration.items():
-        if filter_func(title):
-          activate_cb(self.state_obj, title)
+      self.dispatch(self.get_active_window_title())
+      time.sleep(self.POLL_INTERVAL)
+
+  def dispatch(self, title):
+    # Keep listeners, and the state changes and registrations they make, on the
+    # thread dispatching key reports.
+    self.state_obj.post(
+        self.action_helper.window_changed, self.state_obj, title)
 
   def stop(self):
     self.stopped = True
@@ -103,8 +473,121 @@ class WindowsWindowWatcher(WindowWatcher):
 class LinuxWindowWatcher(WindowWatcher):
   def get_active_window_title(self):
     with open('/dev/null', 'w') as devnull:
-      return subprocess.Popen(
-          ('xdotool', 'getwindowfocus', 'getwindowname'),
-          stdout=subprocess.PIPE, stderr=devnull).communicate()[0]
+      try:
+        return subprocess.Popen(
+            ('xdotool', 'getwindowfocus', 'getwindowname'),
+            stdout=subprocess.PIPE,
+            stderr=devnull).communicate()[0].rstrip('\n')
+      except OSError:
+        return ''  # No xdotool, so no titles, like without a display.
+
+class X11WindowWatcher(WindowWatcher):
+  """Follows the active window through X11 PropertyNotify events.
+
+  Listens for _NET_ACTIVE_WINDOW on the root window and for title changes on
+  the active window, so it only wakes up when focus or the title changes.
+  Connects to $DISPLAY, which may be an Xvfb server. Given an event loop, the
+  X connection is watched by the loop itself instead of a thread.
+  """
+  def __init__(self, action_helper, state_obj):
+    super(X11WindowWatcher, self).__init__(action_helper, state_obj)
+    self.display = Xlib.display.Display()
+    self.root = self.display.screen().root
+    self.NET_ACTIVE_WINDOW = self.display.intern_atom('_NET_ACTIVE_WINDOW')
+    self.NET_WM_NAME = self.display.intern_atom('_NET_WM_NAME')
+    self.UTF8_STRING = self.display.intern_atom('UTF8_STRING')
+    self.active_window = None
+    self.title = ''
+    self.loop_handle = None
+
+  @staticmethod
+  def can_connect():
+    """Returns whether $DISPLAY can be connected to."""
+    try:
+      Xlib.display.Display().close()
+    except (Xlib.error.DisplayError, Xlib.error.ConnectionClosedError,
+            EnvironmentError):
+      return False
+    return True
+
+  def start(self, loop=None):
+    if loop is None:
+      return super(X11WindowWatcher, self).start()
+    self.watch_root()
+    loop.add_reader(self.display.fileno(), self.process_events)
+    # Now and then for new listeners, see ActionHelper.window_changed.
+    self.loop_handle = loop, loop.call_every(1, self.process_events)
+    self.process_events()
+
+  def stop(self):
+    super(X11WindowWatcher, self).stop()
+    if self.loop_handle is not None:
+      loop, handle = self.loop_handle
+      loop.remove_reader(self.display.fileno())
+      handle.cancel()
+      self.display.close()
+
+  def run(self):
+    self.watch_root()
+    while not self.stopped:
+      self.process_events()
+      if not self.display.pending_events():
+        # Wake up now and then to notice stop() and new listeners.
+        select.select([self.display], [], [], 1)
+    self.display.close()
+
+  def watch_root(self):
+    self.root.change_attributes(event_mask=Xlib.X.PropertyChangeMask)
+    self.update_active_window()
+
+  def process_events(self):
+    while self.display.pending_events():
+      self.handle_event(self.display.next_event())
+    # ActionHelper ignores titles it's seen, except for new listeners.
+    self.dispatch(self.title)
+
+  def handle_event(self, event):
+    if event.type != Xlib.X.PropertyNotify:
+      return
+    if event.window == self.root and event.atom == self.NET_ACTIVE_WINDOW:
+      self.update_active_window()
+    elif (self.active_window is not None and
+          event.window.id == self.active_window.id and
+          event.atom in (self.NET_WM_NAME, Xlib.Xatom.WM_NAME)):
+      self.title = self.read_title(self.active_window)
+
+  def update_active_window(self):
+    prop = self.root.get_full_property(
+        self.NET_ACTIVE_WINDOW, Xlib.X.AnyPropertyType)
+    window_id = prop.value[0] if prop and len(prop.value) else 0
+    if self.active_window is not None:
+      try:
+        self.active_window.change_attributes(event_mask=Xlib.X.NoEventMask)
+      except Xlib.error.XError:
+        pass  # Already destroyed.
+    if not window_id:
+      self.active_window = None
+      self.title = ''
+      return
+    self.active_window = self.display.create_resource_object(
+        'window', window_id)
+    try:
+      self.active_window.change_attributes(
+          event_mask=Xlib.X.PropertyChangeMask)
+    except Xlib.error.XError:
+      pass
+    self.title = self.read_title(self.active_window)
+
+  def read_title(self, window):
+    try:
+      prop = window.get_full_property(self.NET_WM_NAME, self.UTF8_STRING)
+      if prop:
+        return prop.value
+      return window.get_wm_name() or ''
+    except Xlib.error.XError:
+      return ''
+
+  def get_active_window_title(self):
+    return self.title
 
 
@@ -0,0 +1,147 @@
+"""Raw key report capture and replay.
+
+ReportRecorder appends every raw 8-byte report a G13 sends to a file, each
+with the wall-clock time it arrived in microseconds, as RECORD after an
+initial MAGIC. replay feeds such a file back through a G13Handler and
+PluginState, either in real time or as fast as possible, which reproduces a
+session without a device and measures how fast the plugins dispatch. The null
+action backend leaves out the cost of injecting what they do:
+
+  python capture.py session.g13r --fast --backend=null
+"""
+import argparse
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from clock import monotonic
+
+MAGIC = 'G13R\x01'
+RECORD = struct.Struct('<Q8s')
+
+
+class ReportRecorder(object):
+  def __init__(self, path):
+    self.file = open(path, 'ab')
+    if not self.file.tell():
+      self.file.write(MAGIC)
+
+  def record(self, report):
+    self.file.write(RECORD.pack(int(time.time() * 1e6), bytes(report)))
+
+  def close(self):
+    self.file.close()
+
+
+def read_reports(path):
+  """Yields (timestamp in seconds, report) for each report in path."""
+  with open(path, 'rb') as f:
+    if f.read(len(MAGIC)) != MAGIC:
+      raise ValueError('%s is not a report capture' % path)
+    while True:
+      record = f.read(RECORD.size)
+      if len(record) < RECORD.size:
+        return
+      timestamp, report = RECORD.unpack(record)
+      yield timestamp / 1e6, report
+
+
+def replay(reports, handler, state, fast=False):
+  """Dispatches (timestamp, report) pairs as if they came from the device.
+
+  Without fast, reports are dispatched as far apart as they were recorded.
+  Returns a dict of how many reports and key events were dispatched and how
+  many of each per second.
+  """
+  num_reports = num_events = 0
+  start = monotonic()
+  first_timestamp = None
+  for timestamp, report in reports:
+    if not fast:
+      if first_timestamp is None:
+        first_timestamp = timestamp
+      due = start + timestamp - first_timestamp
+      # Run timers and other posted commands while waiting, like the runtimes.
+      while True:
+        state.drain_commands()
+        delay = due - monotonic()
+        if delay <= 0:
+          break
+        time.sleep(min(delay, 0.005))
+    new_keys, events = handler.process_report(report)
+    state.dispatch_keys(new_keys, events)
+    num_reports += 1
+    num_events += len(events)
+  state.drain_commands()
+  elapsed = monotonic() - start
+  return {
+    'reports': num_reports,
+    'events': num_events,
+    'seconds': elapsed,
+    'reports_per_second': num_reports / elapsed if elapsed else 0,
+    'events_per_second': num_events / elapsed if elapsed else 0,
+  }
+
+
+def main():
+  import main as stately_main  # Sets up sys.path for g13 first.
+  import g13
+  from actions import ActionHelper
+  from g13_handler import G13Handler
+  from latency import LatencyTracker
+  from plugins import macro_keys
+  from profiling import HandlerProfiler
+  from state import PluginState
+
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('capture', help='File written by ReportRecorder.')
+  parser.add_argument('--fast', action='store_true',
+                      help="Don't wait between reports.")
+  parser.add_argument('--backend',
+                      default=stately_main.action_backend or 'autopy',
+                      help='Action backend, from actions.BACKENDS.')
+  parser.add_argument('--repeat', type=int, default=1,
+                      help='Times to replay the capture.')
+  parser.add_argument('--workers', type=int, default=0,
+                      help='Threads to run key and joystick handlers on, at '
+                      'most 2.')
+  parser.add_argument('--latency', action='store_true',
+                      help='Print per key and plugin dispatch latency.')
+  parser.add_argument('--profile', action='store_true',
+                      help='Print how long each plugin handler took.')
+  args = parser.parse_args()
+
+  # Takes what plugins send to the device, there isn't one.
+  handler = G13Handler(g13.G13(g13.FakeTransport(script=())))
+  state = PluginState(handler, ActionHelper(args.backend),
+                      workers=args.workers)
+  # Replayed MR and M1-M3 presses mustn't overwrite the user's macros.
+  macro_keys.MACRO_DIR = tempfile.mkdtemp(prefix='stately-replay-')
+  for plugin in stately_main.plugins:
+    stately_main.import_string(plugin)(state)
+  if args.latency:
+    latency = LatencyTracker()
+    latency.install(state)
+  if args.profile:
+    state.profiler = HandlerProfiler(stream=sys.stdout)
+  state.enter_state('default')
+  try:
+    for _ in range(args.repeat):
+      stats = replay(read_reports(args.capture), handler, state, args.fast)
+      print ('%(reports)d reports, %(events)d events in %(seconds).3fs: '
+             '%(reports_per_second).0f reports/s, '
+             '%(events_per_second).0f events/s' % stats)
+  finally:
+    for state_name in reversed(state.stack):
+      state.exit_state(state_name)
+    state.stop()
+    shutil.rmtree(macro_keys.MACRO_DIR, ignore_errors=True)
+    if args.latency:
+      latency.dump(sys.stdout)
+    if args.profile:
+      state.profiler.dump()
+
+if __name__ == '__main__':
+  main()
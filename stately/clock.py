@@ -0,0 +1,34 @@
+"""Monotonic clock for timing that mustn't jump with the wall clock.
+
+Python 2 has no time.monotonic, so on Linux this goes to clock_gettime through
+ctypes, falling back to time.time elsewhere.
+"""
+import ctypes
+import ctypes.util
+import time
+
+try:
+  monotonic = time.monotonic
+except AttributeError:
+  class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+  CLOCK_MONOTONIC = 1
+  try:
+    _librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1',
+                         use_errno=True)
+    _clock_gettime = _librt.clock_gettime
+  except (OSError, AttributeError):
+    _clock_gettime = None
+
+  if _clock_gettime is None:
+    monotonic = time.time
+  else:
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+
+    def monotonic():
+      """Seconds since some fixed point, never going backwards."""
+      now = _timespec()
+      if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(now)):
+        raise OSError(ctypes.get_errno(), 'clock_gettime failed')
+      return now.tv_sec + now.tv_nsec * 1e-9
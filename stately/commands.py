@@ -0,0 +1,40 @@
+"""Hands work from other threads to the thread dispatching key reports.
+
+PluginState and the plugins' own state belong to the dispatch thread. Other
+threads, like the window watcher, timers and handler workers, post what they
+need done to a CommandQueue, and the dispatch thread runs it between reports.
+Posting and draining only use deque.append and deque.popleft, which are atomic,
+so the dispatch thread never takes a lock for it.
+"""
+import collections
+import traceback
+
+
+class CommandQueue(collections.deque):
+  """A deque of (func, args), so checking for commands doesn't cost a call."""
+  def __init__(self, wakeup=None):
+    """wakeup, if given, is called after each command is posted.
+
+    It should get the consumer to call drain soon, even without reports.
+    """
+    super(CommandQueue, self).__init__()
+    self.wakeup = wakeup
+
+  def post(self, func, *args):
+    """Queues func(*args) to be called by the consumer. Any thread may call."""
+    self.append((func, args))
+    if self.wakeup is not None:
+      self.wakeup()
+
+  def drain(self):
+    """Runs queued commands, including ones they post, until there are none.
+
+    Must only be called by the consumer.
+    """
+    while self:
+      func, args = self.popleft()
+      try:
+        func(*args)
+      except Exception:
+        # One broken listener shouldn't take down input.
+        traceback.print_exc()
@@ -1,6 +1,5 @@
-import libusb1
-
 import g13
+from clock import monotonic
 
 class G13Keys(object):
   keys = {
@@ -55,27 +54,176 @@ class G13Keys(object):
     return self.keys[key]
   __getitem__ = __getattr__
 
+class KeyDecoder(object):
+  """Turns key reports into (key_name, pressed) events.
+
+  Each key byte gets two 256-entry tables, indexed by the bits pressed or
+  released in that byte, holding prebuilt event tuples for those bits. Decoding
+  a report is then a couple of lookups per changed byte, and a report identical
+  to the previous one is a single comparison.
+  """
+  def __init__(self, num_bytes=5):
+    self.old_keys = bytearray(num_bytes)
+    self.press_tables = []
+    self.release_tables = []
+    for i in range(num_bytes):
+      names = [G13Keys.bytes[(i, j)] for j in range(8)]
+      self.press_tables.append(self._build_table(names, True))
+      self.release_tables.append(self._build_table(names, False))
+
+  @staticmethod
+  def _build_table(names, pressed):
+    events = [(name, pressed) for name in names]
+    return tuple(
+        tuple(event for j, event in enumerate(events) if bits & (1 << j))
+        for bits in range(256))
+
+  def decode(self, new_keys):
+    """Returns the events between the last report and new_keys.
+
+    Within a byte, releases come before presses.
+    """
+    old_keys = self.old_keys
+    if new_keys == old_keys:
+      return ()
+    events = ()
+    for i, new_byte in enumerate(new_keys):
+      changed = new_byte ^ old_keys[i]
+      if not changed:
+        continue
+      events += self.release_tables[i][changed & ~new_byte]
+      events += self.press_tables[i][changed & new_byte]
+    old_keys[:] = new_keys
+    return events
+
+class JoystickFilter(object):
+  """Drops joystick positions that don't meaningfully move the stick.
+
+  Each axis within deadzone of CENTER is snapped to it. Positions within
+  min_change of the last one passed on are dropped, as are positions coming
+  sooner than 1/max_rate seconds after it, if max_rate is set. Going back to
+  center is always passed on so handlers never miss the stick being released.
+
+  The last position dropped for the rate is kept as pending, since the stick
+  may come to rest there without another report. flush passes it on once the
+  rate allows, flush_delay seconds from now.
+  """
+  CENTER = 127
+
+  def __init__(self, deadzone=0, min_change=1, max_rate=None):
+    self.deadzone = deadzone
+    self.min_change = min_change
+    self.min_interval = 1.0 / max_rate if max_rate else 0
+    self.last = None
+    self.last_time = 0
+    self.pending = None
+
+  def __call__(self, stick_x, stick_y):
+    """Returns the (stick_x, stick_y) to dispatch or None to drop it."""
+    center = self.CENTER
+    if abs(stick_x - center) <= self.deadzone:
+      stick_x = center
+    if abs(stick_y - center) <= self.deadzone:
+      stick_y = center
+    position = stick_x, stick_y
+    last = self.last
+    if position == last:
+      self.pending = None
+      return None
+    if last is not None and position != (center, center):
+      if (abs(stick_x - last[0]) < self.min_change and
+          abs(stick_y - last[1]) < self.min_change):
+        self.pending = None
+        return None
+      if self.min_interval:
+        now = monotonic()
+        if now - self.last_time < self.min_interval:
+          self.pending = position
+          return None
+        self.last_time = now
+    self.last = position
+    self.pending = None
+    return position
+
+  def flush_delay(self):
+    return max(0, self.last_time + self.min_interval - monotonic())
+
+  def flush(self):
+    """Returns the pending position if the rate now allows it, else None."""
+    if self.pending is None or self.flush_delay() > 0:
+      return None
+    position = self.last = self.pending
+    self.pending = None
+    self.last_time = monotonic()
+    return position
+
 class G13Handler(object):
-  def __init__(self):
-    self.g13 = g13.G13()
-    self.g13.open()
-    self.old_keys = [0]*6
+  def __init__(self, device=None):
+    """Opens the first G13 found unless given a device to use.
+
+    Pass G13(FakeTransport()) to run without one.
+    """
+    if device is None:
+      device = g13.G13()
+      device.open()
+    self.g13 = device
+    self.old_keys = bytearray(5)
+    self.decoder = KeyDecoder()
+    self.joystick_filter = JoystickFilter()
+    # A latency.LatencyTracker to stamp when reports arrive.
+    self.latency = None
 
-  def maybe_get_new_keys(self):
+  def maybe_get_new_keys(self, timeout=100):
     try:
-      new_keys = self.g13.get_keys()
-    except libusb1.USBError as e:
-      if e.value != -7:  # Ignore timeouts
-        raise
+      new_keys = self.g13.get_keys(timeout)
+    except g13.G13TimeoutError:
       return None, None
     else:
-      return new_keys, self.diff_keys(new_keys.keys)
+      if self.latency is not None:
+        self.latency.report_received()
+      return new_keys, self.decoder.decode(new_keys.keys)
+
+  def process_report(self, data):
+    """Decodes a raw report as if it came from the device."""
+    if self.latency is not None:
+      self.latency.report_received()
+    new_keys = self.g13.parse_keys(data)
+    return new_keys, self.decoder.decode(new_keys.keys)
+
+  def start_listening(self, callback):
+    """Switches to async key transfers, calling callback(new_keys, events).
+
+    Reports are only delivered while handle_events is being called.
+    """
+    def keys_received(new_keys):
+      if self.latency is not None:
+        self.latency.report_received()
+      callback(new_keys, self.decoder.decode(new_keys.keys))
+    self.g13.start_key_transfers(keys_received)
+
+  def stop_listening(self):
+    self.g13.stop_key_transfers()
+
+  @property
+  def listening(self):
+    return self.g13.listening
+
+  def handle_events(self, timeout=None):
+    self.g13.handle_events(timeout)
+
+  def poll_fds(self):
+    return self.g13.poll_fds()
+
+  def interrupt_events(self):
+    self.g13.interrupt_events()
 
   def diff_keys(self, new_keys):
+    """Returns the changed bits per byte, see KeyDecoder for named events."""
     diff = bytearray(6)
     for i, (old_byte, new_byte) in enumerate(zip(self.old_keys, new_keys)):
       if old_byte != new_byte:
         diff[i] = new_byte ^ old_byte
-    self.old_keys = new_keys
+    # new_keys is reused by G13 for the next report, so copy it.
+    self.old_keys[:] = new_keys
     return diff
 
@@ -0,0 +1,153 @@
+"""Input latency measurement, from a key report arriving to actions injected.
+
+A LatencyTracker installed on a PluginState gets timestamps from the
+G13Handler when a report arrives, from PluginState when each key event in it
+is dispatched and from the ActionHelper when an action has been injected. It
+keeps a Histogram per key of report to dispatch and report to injection times,
+and per plugin of report to injection times of the actions its handlers
+injected. Without one installed, all that's left of it is an `is not None`
+check at each of those points.
+
+Actions injected outside of dispatching a report, by timers, macros or
+PluginState's workers, aren't counted.
+"""
+import math
+import sys
+import thread
+
+from clock import monotonic
+
+
+class Histogram(object):
+  """Counts durations into buckets a quarter of an octave wide.
+
+  Percentiles are accurate to within a bucket, about 19%, which is plenty to
+  tell 200us from 2ms. max is exact.
+  """
+  SUBBUCKETS = 4
+
+  def __init__(self):
+    self.buckets = {}
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def add(self, seconds):
+    mantissa, exponent = math.frexp(seconds * 1e6)
+    bucket = exponent * self.SUBBUCKETS + int((mantissa - 0.5) *
+                                              2 * self.SUBBUCKETS)
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.count += 1
+    self.total += seconds
+    if seconds > self.max:
+      self.max = seconds
+
+  def _bucket_top(self, bucket):
+    exponent, sub = divmod(bucket + 1, self.SUBBUCKETS)
+    return math.ldexp(0.5 + sub / (2.0 * self.SUBBUCKETS), exponent) / 1e6
+
+  def percentile(self, percent):
+    """Returns the top of the bucket the percent'th duration is in."""
+    if not self.count:
+      return 0.0
+    rank = self.count * percent / 100.0
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= rank:
+        return min(self._bucket_top(bucket), self.max)
+    return self.max
+
+  @property
+  def mean(self):
+    return self.total / self.count if self.count else 0.0
+
+
+class LatencyTracker(object):
+  def __init__(self):
+    self.report_time = None
+    self.key = None
+    # The plugin whose handler is running, set by PluginState.
+    self.plugin = None
+    self.dispatch_thread = None
+    self.dispatch = {}
+    self.key_injection = {}
+    self.plugin_injection = {}
+
+  def install(self, state_obj):
+    """Starts getting timestamps from state_obj, its handler and actions."""
+    state_obj.latency = self
+    state_obj.handler.latency = self
+    state_obj.action.latency = self
+
+  @staticmethod
+  def uninstall(state_obj):
+    state_obj.latency = None
+    state_obj.handler.latency = None
+    state_obj.action.latency = None
+
+  def reset(self):
+    self.dispatch = {}
+    self.key_injection = {}
+    self.plugin_injection = {}
+
+  @staticmethod
+  def _histogram(histograms, name):
+    histogram = histograms.get(name)
+    if histogram is None:
+      histogram = histograms[name] = Histogram()
+    return histogram
+
+  # Called by G13Handler, PluginState and ActionHelper.
+  def report_received(self):
+    self.report_time = monotonic()
+
+  def dispatching(self, key):
+    """Marks the start of dispatching key's event from the last report."""
+    self.key = key
+    self.dispatch_thread = thread.get_ident()
+    if self.report_time is not None:
+      self._histogram(self.dispatch, key).add(monotonic() - self.report_time)
+
+  def dispatched(self):
+    self.key = None
+    self.dispatch_thread = None
+
+  def injected(self):
+    if (self.key is None or self.report_time is None or
+        self.dispatch_thread != thread.get_ident()):
+      return
+    elapsed = monotonic() - self.report_time
+    self._histogram(self.key_injection, self.key).add(elapsed)
+    if self.plugin is not None:
+      self._histogram(self.plugin_injection, self.plugin).add(elapsed)
+
+  def summary(self):
+    """Returns a table of p50/p99/max in milliseconds of every histogram."""
+    lines = ['%-28s %8s %8s %8s %8s' % ('ms', 'count', 'p50', 'p99', 'max')]
+    for title, histograms in (
+        ('report -> dispatch, by key', self.dispatch),
+        ('report -> injection, by key', self.key_injection),
+        ('report -> injection, by plugin', self.plugin_injection)):
+      if not histograms:
+        continue
+      lines.append(title)
+      for name in sorted(histograms):
+        histogram = histograms[name]
+        lines.append('  %-26s %8d %8.3f %8.3f %8.3f' % (
+            name, histogram.count, histogram.percentile(50) * 1e3,
+            histogram.percentile(99) * 1e3, histogram.max * 1e3))
+    return '\n'.join(lines)
+
+  def dump(self, stream=None):
+    stream = stream or sys.stderr
+    stream.write(self.summary() + '\n')
+    stream.flush()
+
+
+def plugin_name(func):
+  """Names the plugin func belongs to, by its class if it's a method."""
+  obj = getattr(func, '__self__', None)
+  if obj is not None:
+    return type(obj).__name__
+  return getattr(func, '__module__', None) or type(func).__name__
@@ -0,0 +1,243 @@
+"""Single-threaded event loop for stately.
+
+Python 2 has no asyncio, so this is a small select()-based loop along the same
+lines. It multiplexes file descriptors (libusb's, the X server connection),
+timers and generator-based coroutines on one thread, so plugins can schedule
+work without starting threads of their own. It relies on select() working on
+pipes and libusb's file descriptors, so it's Unix only.
+
+Callbacks, timers, coroutines and file descriptors may be added from any
+thread, which wakes the loop up to notice them. Exceptions from callbacks are
+printed rather than stopping the loop.
+
+Coroutines are generators that yield the number of seconds to sleep before
+being resumed (None or 0 to just let everything else run first):
+
+  def blink(state):
+    for _ in range(10):
+      state.handler.g13.set_mode_leds(1)
+      yield 0.5
+      state.handler.g13.set_mode_leds(0)
+      yield 0.5
+
+  state.loop.spawn(blink(state))
+"""
+import collections
+import errno
+import heapq
+import itertools
+import os
+import select
+import thread
+import threading
+import traceback
+
+from clock import monotonic
+
+
+class Handle(object):
+  """A scheduled callback, cancel() stops it from running (again)."""
+  __slots__ = ('callback', 'args', 'cancelled')
+
+  def __init__(self, callback, args):
+    self.callback = callback
+    self.args = args
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+
+  def run(self):
+    self.callback(*self.args)
+
+
+class RepeatingHandle(Handle):
+  __slots__ = ('loop', 'interval', 'when')
+
+  def __init__(self, loop, interval, callback, args):
+    super(RepeatingHandle, self).__init__(callback, args)
+    self.loop = loop
+    self.interval = interval
+    self.when = monotonic()
+
+  def run(self):
+    try:
+      self.callback(*self.args)
+    finally:
+      # Reschedule from when it was due so the period doesn't drift.
+      self.when = max(self.when + self.interval, monotonic())
+      if not self.cancelled:
+        self.loop._schedule(self.when, self)
+
+
+class Task(Handle):
+  """Runs a generator-based coroutine, see the module docstring."""
+  __slots__ = ('loop', 'coroutine')
+
+  def __init__(self, loop, coroutine):
+    super(Task, self).__init__(None, ())
+    self.loop = loop
+    self.coroutine = coroutine
+
+  def cancel(self):
+    super(Task, self).cancel()
+    try:
+      self.coroutine.close()
+    except ValueError:
+      pass  # Cancelling itself, it won't be rescheduled.
+
+  def run(self):
+    try:
+      delay = next(self.coroutine)
+    except StopIteration:
+      return
+    if not self.cancelled:
+      self.loop._schedule(monotonic() + (delay or 0), self)
+
+
+class EventLoop(object):
+  def __init__(self):
+    self.readers = {}
+    self.writers = {}
+    self.timers = []
+    self.counter = itertools.count()
+    self.ready = collections.deque()
+    self.running = False
+    # The thread in run(), which doesn't need waking up for what it adds.
+    self.thread = None
+    # Guards timers and wakeup_pending against other threads.
+    self.lock = threading.Lock()
+    # Written to by other threads to wake up select(). At most one byte is ever
+    # in it, so neither end blocks.
+    self.wakeup_read, self.wakeup_write = os.pipe()
+    self.wakeup_pending = False
+    self.add_reader(self.wakeup_read, self._drain_wakeup)
+
+  # File descriptors
+  def add_reader(self, fd, callback, *args):
+    self.readers[fd] = Handle(callback, args)
+    self._wakeup()
+  def remove_reader(self, fd):
+    self.readers.pop(fd, None)
+    self._wakeup()
+  def add_writer(self, fd, callback, *args):
+    self.writers[fd] = Handle(callback, args)
+    self._wakeup()
+  def remove_writer(self, fd):
+    self.writers.pop(fd, None)
+    self._wakeup()
+
+  # Callbacks and timers
+  def call_soon(self, callback, *args):
+    handle = Handle(callback, args)
+    self.ready.append(handle)
+    self._wakeup()
+    return handle
+
+  # Everything wakes the loop up when needed now, this is kept for callers.
+  call_soon_threadsafe = call_soon
+
+  def time(self):
+    """The clock call_at goes by, which doesn't jump with the wall clock."""
+    return monotonic()
+
+  def call_later(self, delay, callback, *args):
+    return self.call_at(monotonic() + delay, callback, *args)
+
+  def call_at(self, when, callback, *args):
+    handle = Handle(callback, args)
+    self._schedule(when, handle)
+    return handle
+
+  def call_every(self, interval, callback, *args, **kwargs):
+    """Calls callback every interval seconds.
+
+    The first call is after interval seconds, or delay if it's given.
+    """
+    handle = RepeatingHandle(self, interval, callback, args)
+    handle.when += kwargs.get('delay', interval)
+    self._schedule(handle.when, handle)
+    return handle
+
+  def spawn(self, coroutine):
+    """Starts running a generator-based coroutine, returns its Task."""
+    task = Task(self, coroutine)
+    self.ready.append(task)
+    self._wakeup()
+    return task
+
+  def _schedule(self, when, handle):
+    with self.lock:
+      heapq.heappush(self.timers, (when, next(self.counter), handle))
+    self._wakeup()
+
+  def _wakeup(self):
+    """Wakes up select() if called from a thread other than the loop's."""
+    if thread.get_ident() == self.thread:
+      return
+    with self.lock:
+      if self.wakeup_pending:
+        return
+      self.wakeup_pending = True
+    os.write(self.wakeup_write, b'x')
+
+  def _drain_wakeup(self):
+    with self.lock:
+      self.wakeup_pending = False
+    os.read(self.wakeup_read, 1)
+
+  # Running
+  def run(self):
+    """Runs until stop() is called."""
+    self.running = True
+    self.thread = thread.get_ident()
+    try:
+      while self.running:
+        self.run_once()
+    finally:
+      self.thread = None
+
+  def stop(self):
+    """Stops run() after this iteration, may be called from any thread."""
+    self.running = False
+    self._wakeup()
+
+  def run_once(self):
+    with self.lock:
+      if self.ready:
+        timeout = 0
+      elif self.timers:
+        timeout = max(0, self.timers[0][0] - monotonic())
+      else:
+        timeout = None
+    try:
+      readable, writable, _ = select.select(
+          list(self.readers), list(self.writers), [], timeout)
+    except select.error as e:
+      if e.args[0] != errno.EINTR:
+        raise
+      readable, writable = [], []
+    for fd in readable:
+      handle = self.readers.get(fd)
+      if handle is not None:
+        self.ready.append(handle)
+    for fd in writable:
+      handle = self.writers.get(fd)
+      if handle is not None:
+        self.ready.append(handle)
+
+    now = monotonic()
+    with self.lock:
+      timers = self.timers
+      while timers and timers[0][0] <= now:
+        self.ready.append(heapq.heappop(timers)[2])
+
+    # Only run what's ready now, callbacks scheduled by these wait a turn.
+    for _ in range(len(self.ready)):
+      handle = self.ready.popleft()
+      if not handle.cancelled:
+        try:
+          handle.run()
+        except Exception:
+          # Like CommandQueue.drain, one broken plugin shouldn't stop the loop.
+          traceback.print_exc()
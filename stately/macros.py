@@ -0,0 +1,193 @@
+"""Macro recording and playback.
+
+MacroRecorder records the actions plugins inject through an ActionHelper, with
+the time between them, into a Macro. MacroPlayer plays a Macro back through an
+ActionHelper on its own thread, so the input loop never waits on it.
+
+Macros are stored as MAGIC followed by one fixed-size RECORD per action:
+microseconds since the previous action, the action's opcode and its two
+arguments. Keys that are characters are stored as -ord(char) - 1, other keys as
+their ActionHelper KEY_ and MOUSE_ values. Version 1 files used autopy's values
+for those, which can't be told apart from the current ones, so they're refused.
+"""
+import struct
+import threading
+import time
+
+from clock import monotonic
+
+MAGIC = 'G13M\x02'
+RECORD = struct.Struct('<IBii')
+MAX_DELAY = 0xffffffff
+
+PRESS_KEY, RELEASE_KEY, TAP_KEY, MOUSE_RELATIVE, MOUSE_TOGGLE = range(1, 6)
+
+
+def encode_key(key):
+  if isinstance(key, basestring):
+    return -ord(key) - 1
+  return key
+
+def decode_key(value):
+  if value < 0:
+    return chr(-value - 1)
+  return value
+
+
+class Macro(object):
+  def __init__(self, data=''):
+    self.data = bytearray(data)
+
+  def append(self, delay, opcode, arg1, arg2):
+    delay = min(int(delay * 1e6), MAX_DELAY)
+    self.data += RECORD.pack(delay, opcode, arg1, arg2)
+
+  def __iter__(self):
+    """Yields (delay in seconds, opcode, arg1, arg2) for each action."""
+    for offset in xrange(0, len(self.data), RECORD.size):
+      delay, opcode, arg1, arg2 = RECORD.unpack_from(self.data, offset)
+      yield delay / 1e6, opcode, arg1, arg2
+
+  def __len__(self):
+    return len(self.data) // RECORD.size
+
+  @property
+  def duration(self):
+    return sum(delay for delay, _, _, _ in self)
+
+  def save(self, path):
+    with open(path, 'wb') as f:
+      f.write(MAGIC)
+      f.write(self.data)
+
+  @classmethod
+  def load(cls, path):
+    with open(path, 'rb') as f:
+      data = f.read()
+    if data.startswith(MAGIC[:-1]) and not data.startswith(MAGIC):
+      raise ValueError('%s was recorded by an older version, record it again'
+                       % path)
+    if not data.startswith(MAGIC) or (len(data) - len(MAGIC)) % RECORD.size:
+      raise ValueError('%s is not a macro file' % path)
+    return cls(data[len(MAGIC):])
+
+
+class MacroRecorder(object):
+  """Records the actions going through an ActionHelper.
+
+  While recording it stands in for the helper's backend, passing every action
+  on to it, so recorded actions still happen.
+  """
+  def __init__(self, action_helper):
+    self.action_helper = action_helper
+    self.backend = None
+    self.macro = None
+    self.last_time = None
+
+  @property
+  def recording(self):
+    return self.backend is not None
+
+  def start(self):
+    if self.recording:
+      return
+    self.macro = Macro()
+    self.last_time = None
+    self.backend = self.action_helper.backend
+    self.action_helper.backend = self
+
+  def stop(self):
+    """Stops recording and returns the Macro."""
+    if self.recording:
+      self.action_helper.backend = self.backend
+      self.backend = None
+    return self.macro
+
+  def _record(self, opcode, arg1, arg2):
+    now = monotonic()
+    delay = now - self.last_time if self.last_time is not None else 0
+    self.last_time = now
+    self.macro.append(delay, opcode, arg1, arg2)
+
+  def press_key(self, key, modifiers):
+    self._record(PRESS_KEY, encode_key(key), modifiers)
+    self.backend.press_key(key, modifiers)
+  def release_key(self, key, modifiers):
+    self._record(RELEASE_KEY, encode_key(key), modifiers)
+    self.backend.release_key(key, modifiers)
+  def tap_key(self, key, modifiers):
+    self._record(TAP_KEY, encode_key(key), modifiers)
+    self.backend.tap_key(key, modifiers)
+  def mouse_relative(self, x, y):
+    self._record(MOUSE_RELATIVE, x, y)
+    self.backend.mouse_relative(x, y)
+  def mouse_toggle(self, down, button):
+    self._record(MOUSE_TOGGLE, int(bool(down)), button)
+    self.backend.mouse_toggle(down, button)
+
+
+class MacroPlayer(object):
+  """Plays macros back on a thread of its own.
+
+  Sleeps until SPIN_TIME before each action is due, then yields the GIL with
+  time.sleep(0) until it is, so actions happen within about a millisecond of
+  when they should without starving the thread reading reports. With fast,
+  actions are played back to back instead.
+  """
+  SPIN_TIME = 0.001
+  # Longest sleep between checking whether stop() was called.
+  MAX_SLEEP = 0.1
+
+  def __init__(self, action_helper):
+    self.action_helper = action_helper
+    self.thread = None
+    self.stopped = False
+
+  @property
+  def playing(self):
+    return self.thread is not None and self.thread.is_alive()
+
+  def play(self, macro, fast=False):
+    self.stop()
+    self.stopped = False
+    self.thread = threading.Thread(
+        target=self._play, args=(macro, fast), name='MacroPlayer')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def stop(self):
+    if self.playing:
+      self.stopped = True
+      if self.thread is not threading.current_thread():
+        self.thread.join()
+
+  def _play(self, macro, fast):
+    due = monotonic()
+    for delay, opcode, arg1, arg2 in macro:
+      if not fast:
+        due += delay
+        while not self.stopped:
+          remaining = due - monotonic()
+          if remaining <= self.SPIN_TIME:
+            break
+          time.sleep(min(remaining - self.SPIN_TIME, self.MAX_SLEEP))
+        while monotonic() < due and not self.stopped:
+          time.sleep(0)
+      if self.stopped:
+        return
+      self._perform(opcode, arg1, arg2)
+
+  def _perform(self, opcode, arg1, arg2):
+    action = self.action_helper
+    if opcode == PRESS_KEY:
+      action.press_key(decode_key(arg1), arg2)
+    elif opcode == RELEASE_KEY:
+      action.release_key(decode_key(arg1), arg2)
+    elif opcode == TAP_KEY:
+      action.tap_key(decode_key(arg1), arg2)
+    elif opcode == MOUSE_RELATIVE:
+      action.mouse_relative(arg1, arg2)
+    elif opcode == MOUSE_TOGGLE:
+      action.mouse_toggle(bool(arg1), arg2)
+    else:
+      raise ValueError('Unknown macro opcode %d' % opcode)
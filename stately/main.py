@@ -1,9 +1,17 @@
 import importlib
+import platform
+import select
+import signal
 import sys
+import threading
 sys.path.insert(0, 'deps')
 
-from g13_handler import G13Handler, G13Keys
+from g13_handler import G13Handler, JoystickFilter
 from actions import ActionHelper
+from capture import ReportRecorder
+from latency import LatencyTracker
+from profiling import HandlerProfiler
+from loop import EventLoop
 from state import PluginState
 
 """
@@ -12,20 +20,27 @@ the given argument's register_plugin method. This argument is the
 state, and is given to the functions registered for entering/exiting
 states. Plugins should call register_plugin with a dictionary of
 state names to action dictionaries, which should consist of one or
-more of the keys enter, exit, key_press, and key_release.
+more of the keys enter, exit, joystick, key_press, key_release, key_hold,
+key_repeat and key_double_tap.
 
 enter and exit should be functions that take a state argument and
 are called when the state with the name they're registered for is
 entered or exited.
 
-key_press and key_release should be dictionaries of key names to
-functions that take the state object and which key was pressed.
+key_press, key_release and the other key_ actions should be dictionaries of
+key names to functions that take the state object and which key was pressed.
+
+Plugins that need timers should use state.call_later and state.call_every,
+and ones needing background work state.loop, an EventLoop, rather than
+starting threads. Anything that does run on another thread should use
+state.post to touch the state or registrations.
 """
 
 plugins = [
   # 'plugins.example.register',
   'plugins.chrome.register',
   'plugins.os.register',
+  'plugins.macro_keys.register',
 ]
 
 def import_string(modstr):
@@ -33,37 +48,164 @@ def import_string(modstr):
   module = importlib.import_module(mod)
   return getattr(module, func)
 
+# How actions are injected, one of actions.BACKENDS. 'uinput' needs
+# python-evdev and write access to /dev/uinput, 'null' and 'recording' don't
+# inject anything. None picks 'autopy', or 'recording' with fake_device so the
+# random reports don't click, type or close tabs for real.
+action_backend = None
+
+# How input is read:
+#   'loop': USB, window titles, timers and coroutines all share one EventLoop.
+#   'async': async libusb transfers on the main thread, state.loop runs on its
+#     own thread.
+#   'sync': polls for key reports with a timeout, state.loop runs on its own
+#     thread.
+# EventLoop is Unix only, so Windows uses 'async' and has no state.loop.
+runtime = 'async' if platform.system() == 'Windows' else 'loop'
+
+# Joystick axes within joystick_deadzone of center count as centered, and
+# moves smaller than joystick_min_change aren't dispatched. Set
+# joystick_max_rate to also cap joystick events per second.
+joystick_deadzone = 8
+joystick_min_change = 2
+joystick_max_rate = None
+
+# Set to a path to append every raw key report to, see capture.py.
+capture_path = None
+
+# Set to run against g13.FakeTransport's random reports instead of a G13, for
+# trying plugins or profiling without one.
+fake_device = False
+
+# Set to measure how long reports take to turn into injected actions, per key
+# and plugin. The stats are printed on exit, on SIGUSR1 and, if set, every
+# latency_interval seconds.
+latency_stats = False
+latency_interval = None
+
+# Set to run key and joystick handlers on worker threads instead of the one
+# reading reports, so slow plugins don't delay reads. Key handlers still all
+# run in order, on one worker, and joystick handlers on another, so at most 2
+# are started.
+handler_workers = 0
+
+# Set to time every plugin handler call, warning about calls taking over
+# handler_budget seconds. Handlers are printed slowest first on exit and on
+# SIGUSR1.
+profile_handlers = False
+handler_budget = 0.005
+
+# Longest the 'async' runtime goes without running commands posted by other
+# threads, like window title changes and timers, when no reports come in and
+# libusb is too old to be woken up for them. The 'sync' runtime can't be woken
+# up, it runs them on every read timeout: every 100ms, or every
+# sync_timer_interval while timers are pending.
+command_interval = 0.1
+sync_timer_interval = 0.005
+
 def listen_for_keys(handler, state):
   while True: # for _ in range(500):
-    new_keys, changed_keys = handler.maybe_get_new_keys()
+    timeout = sync_timer_interval if state.timers.pending else 0.1
+    new_keys, events = handler.maybe_get_new_keys(int(timeout * 1000))
     if not new_keys:  # Checking for None, not all 0s.
+      state.drain_commands()
       continue
+    state.dispatch_keys(new_keys, events)
+
+def listen_for_keys_async(handler, state):
+  state.commands.wakeup = handler.interrupt_events
+  handler.start_listening(state.dispatch_keys)
+  try:
+    while handler.listening:
+      handler.handle_events(command_interval)
+      state.drain_commands()
+  finally:
+    handler.stop_listening()
 
-    # Check/call any registered events.
-    state.joystick(new_keys.stick_x, new_keys.stick_y)
-    for i, byte in enumerate(changed_keys):
-      if not byte: # Skip byte early.
-        continue
-      for j in range(8):
-        if byte & 1:
-          key = G13Keys.bytes[(i, j)]
-          state.key_changed(key, new_keys.keys[i] & (1<<j))
-        byte >>= 1
+def run_loop(handler, state):
+  """Runs key reports, and everything else on state.loop, on one thread."""
+  loop = state.loop
+  state.commands.wakeup = lambda: loop.call_soon_threadsafe(
+      state.drain_commands)
+  def handle_events():
+    handler.handle_events(0)
+    if not handler.listening:
+      # Reads ended: the G13 went away or a fake one ran out of reports. Stop
+      # like the 'async' runtime does.
+      loop.stop()
+  handler.start_listening(state.dispatch_keys)
+  fds = handler.poll_fds()
+  for fd, events in fds:
+    if events & select.POLLIN:
+      loop.add_reader(fd, handle_events)
+    if events & select.POLLOUT:
+      loop.add_writer(fd, handle_events)
+  try:
+    loop.run()
+  finally:
+    for fd, _ in fds:
+      loop.remove_reader(fd)
+      loop.remove_writer(fd)
+    handler.stop_listening()
 
 if __name__ == '__main__':
-  handler = G13Handler()
-  action_helper = ActionHelper()
-  state = PluginState(handler, action_helper)
+  if fake_device:
+    import g13
+    handler = G13Handler(g13.G13(g13.FakeTransport()))
+  else:
+    handler = G13Handler()
+  handler.joystick_filter = JoystickFilter(
+      joystick_deadzone, joystick_min_change, joystick_max_rate)
+  if capture_path:
+    recorder = ReportRecorder(capture_path)
+    handler.g13.report_listener = recorder.record
+  backend = action_backend
+  if backend is None:
+    backend = 'recording' if fake_device else 'autopy'
+  action_helper = ActionHelper(backend)
+  loop = EventLoop() if platform.system() != 'Windows' else None
+  state = PluginState(handler, action_helper, loop, handler_workers,
+                      timers_on_loop=runtime == 'loop')
   for plugin in plugins:
     func = import_string(plugin)
     func(state)
+  stats = []
+  if latency_stats:
+    latency = LatencyTracker()
+    latency.install(state)
+    stats.append(latency)
+    if latency_interval:
+      state.call_every(latency_interval, latency.dump)
+  if profile_handlers:
+    state.profiler = HandlerProfiler(handler_budget)
+    stats.append(state.profiler)
+  if stats and hasattr(signal, 'SIGUSR1'):
+    signal.signal(signal.SIGUSR1,
+                  lambda signum, frame: [s.dump() for s in stats])
+
+  if loop is not None and runtime != 'loop':
+    loop_thread = threading.Thread(target=loop.run, name='EventLoop')
+    loop_thread.daemon = True
+    loop_thread.start()
 
   state.enter_state('default')
-  state.action.start_window_listener(state)
+  state.action.start_window_listener(state, loop)
   try:
-    listen_for_keys(handler, state)
+    if runtime == 'loop':
+      run_loop(handler, state)
+    elif runtime == 'async':
+      listen_for_keys_async(handler, state)
+    else:
+      listen_for_keys(handler, state)
   finally:
     for state_name in reversed(state.stack):
       state.exit_state(state_name)
     state.action.stop_window_listener()
+    state.stop()
+    if capture_path:
+      recorder.close()
+    for s in stats:
+      s.dump()
+    if loop is not None:
+      loop.stop()
 
@@ -0,0 +1,91 @@
+"""Turns joystick positions into smooth relative mouse motion.
+
+MouseMotion treats the stick as a velocity. Outside a radial deadzone, how far
+it's pushed goes through an acceleration curve and scales max_speed pixels a
+second. While it's deflected a timer ticks rate times a second, adding that
+velocity times the time since the last tick to a fractional position and moving
+the mouse by the whole pixels in it, keeping the fraction for the next tick.
+Slow, precise movements that would round to nothing each tick still add up.
+Back at rest the timer is cancelled, so a centered stick costs nothing.
+"""
+from clock import monotonic
+
+CENTER = 127
+
+# Map how far the stick is pushed, 0 to 1 past the deadzone, to the fraction of
+# max_speed to move at.
+CURVES = {
+  'linear': lambda m: m,
+  'quadratic': lambda m: m * m,
+  'cubic': lambda m: m * m * m,
+  # Gentle at both ends, for precision near center without a slow top end.
+  'smooth': lambda m: m * m * (3 - 2 * m),
+}
+
+
+class MouseMotion(object):
+  def __init__(self, action_helper, call_every, max_speed=1000.0,
+               curve='quadratic', deadzone=0.1, rate=100):
+    """call_every(interval, func) schedules ticks, e.g. PluginState.call_every.
+
+    curve is a name from CURVES or a function of the same kind, deadzone the
+    fraction of the stick's travel around center that doesn't move the mouse.
+    """
+    self.action = action_helper
+    self.call_every = call_every
+    self.max_speed = max_speed
+    self.curve = CURVES[curve] if isinstance(curve, basestring) else curve
+    self.deadzone = deadzone
+    self.interval = 1.0 / rate
+    self.velocity = 0.0, 0.0
+    self.remainder_x = self.remainder_y = 0.0
+    self.timer = None
+    self.last_tick = None
+
+  @property
+  def moving(self):
+    return self.timer is not None
+
+  def set_stick(self, stick_x, stick_y):
+    """Sets the velocity from a raw joystick position."""
+    x = max(-1.0, min(1.0, (stick_x - CENTER) / float(CENTER)))
+    y = max(-1.0, min(1.0, (stick_y - CENTER) / float(CENTER)))
+    magnitude = (x * x + y * y) ** 0.5
+    if magnitude <= self.deadzone:
+      self.velocity = 0.0, 0.0
+      self._stop_ticking()
+      return
+    # Scale what's past the deadzone back to 0-1, so motion starts from 0 at
+    # its edge rather than jumping.
+    pushed = min(1.0, (magnitude - self.deadzone) / (1 - self.deadzone))
+    speed = self.max_speed * self.curve(pushed) / magnitude
+    self.velocity = x * speed, y * speed
+    if self.timer is None:
+      self.last_tick = monotonic()
+      self.timer = self.call_every(self.interval, self.tick)
+
+  def tick(self):
+    now = monotonic()
+    # Catch up on a late tick, but not so far that a stall flings the cursor.
+    elapsed = min(now - self.last_tick, 3 * self.interval)
+    self.last_tick = now
+    velocity_x, velocity_y = self.velocity
+    self.remainder_x += velocity_x * elapsed
+    self.remainder_y += velocity_y * elapsed
+    # int() truncates toward 0, so the fractions keep their direction's sign.
+    move_x = int(self.remainder_x)
+    move_y = int(self.remainder_y)
+    if move_x or move_y:
+      self.remainder_x -= move_x
+      self.remainder_y -= move_y
+      self.action.mouse_relative(move_x, move_y)
+
+  def _stop_ticking(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    self.remainder_x = self.remainder_y = 0.0
+
+  def stop(self):
+    self.velocity = 0.0, 0.0
+    self._stop_ticking()
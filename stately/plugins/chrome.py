@@ -5,12 +5,10 @@ class ChromePlugin(object):
     self.reversed = False
 
   def start_listening(self, state_obj, new_state):
-    state_obj.action.register_window_listener(
-        self.window_title_filter, self.activate)
+    self.window_match = state_obj.action.register_window_match(
+        self.activate, suffix='Google Chrome')
   def stop_listening(self, state_obj, new_state):
-    state_obj.action.unregister_window_listener(self.window_title_filter)
-  def window_title_filter(self, title):
-    return title.endswith('Google Chrome')
+    state_obj.action.unregister_window_match(self.window_match)
 
   def activate(self, state_obj, title):
     print 'activating our state due to title:', title
@@ -1,14 +1,9 @@
-import threading
-import time
-
 class ExamplePlugin(object):
   def default_entered(self, state_obj, new_state):
-    # Activates self in 5 seconds, simulates the OS doing so.
-    threading.Thread(target=self.self_activate,
-                     args=(state_obj,)).start()
+    # Activates self in 2 seconds, simulates the OS doing so.
+    state_obj.call_later(2, self.self_activate, state_obj)
 
   def self_activate(self, state):
-    time.sleep(2)
     print 'activating our state'
     state.enter_state('example_state')
 
@@ -21,6 +16,12 @@ class ExamplePlugin(object):
   def G1_release(self, state_obj, key):
     print 'key released', state_obj, key
 
+  def G1_hold(self, state_obj, key):
+    print 'key held', state_obj, key
+
+  def G1_double_tap(self, state_obj, key):
+    print 'key double tapped', state_obj, key
+
   def __str__(self):
     return self.__class__.__name__
   __repr__ = __str__
@@ -41,6 +42,12 @@ def register(state):
       'key_release': {
         'G1': plugin.G1_release,
       },
+      'key_hold': {
+        'G1': plugin.G1_hold,
+      },
+      'key_double_tap': {
+        'G1': plugin.G1_double_tap,
+      },
     },
   })
 
@@ -0,0 +1,74 @@
+from __future__ import absolute_import
+
+import os
+
+from macros import Macro, MacroPlayer, MacroRecorder
+
+# Where register keeps the macros, e.g. pointed elsewhere when replaying.
+MACRO_DIR = os.path.expanduser('~/.stately/macros')
+
+class MacroKeysPlugin(object):
+  """Records and plays macros on the M1-M3 keys, like Logitech's software.
+
+  Press MR, do whatever should be recorded and then press one of M1-M3 to save
+  it there, or MR again to throw it away. Pressing M1-M3 plays their macro.
+  """
+  MACRO_KEYS = ('MACRO1', 'MACRO2', 'MACRO3')
+  # Bits for G13.set_mode_leds.
+  LEDS = {'MACRO1': 1, 'MACRO2': 2, 'MACRO3': 4, 'MACRO_RECORD': 8}
+
+  def __init__(self, action_helper, directory):
+    self.recorder = MacroRecorder(action_helper)
+    self.player = MacroPlayer(action_helper)
+    self.directory = directory
+    self.macros = {}
+    for key in self.MACRO_KEYS:
+      if os.path.exists(self.path(key)):
+        try:
+          self.macros[key] = Macro.load(self.path(key))
+        except ValueError as e:
+          print 'WARNING: Not loading macro:', e
+
+  def path(self, key):
+    return os.path.join(self.directory, key + '.g13m')
+
+  def set_leds(self, state_obj, key=None):
+    state_obj.handler.g13.set_mode_leds(self.LEDS.get(key, 0))
+
+  def record(self, state_obj, key):
+    if self.recorder.recording:
+      self.recorder.stop()
+      self.set_leds(state_obj)
+    else:
+      self.recorder.start()
+      self.set_leds(state_obj, key)
+
+  def macro_key(self, state_obj, key):
+    if self.recorder.recording:
+      self.macros[key] = self.recorder.stop()
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+      self.macros[key].save(self.path(key))
+      self.set_leds(state_obj, key)
+    elif key in self.macros:
+      self.set_leds(state_obj, key)
+      self.player.play(self.macros[key])
+
+  def stop(self, state_obj, new_state):
+    self.recorder.stop()
+    self.player.stop()
+
+  def __str__(self):
+    return self.__class__.__name__
+  __repr__ = __str__
+
+def register(state):
+  plugin = MacroKeysPlugin(state.action, MACRO_DIR)
+  key_press = {key: plugin.macro_key for key in plugin.MACRO_KEYS}
+  key_press['MACRO_RECORD'] = plugin.record
+  state.register_plugin(states={
+    'default': {
+      'exit': plugin.stop,
+      'key_press': key_press,
+    },
+  })
@@ -0,0 +1,81 @@
+"""Times plugin handlers to find the ones holding up input.
+
+Handlers run inline with key reports, so one that blocks, even on a print to a
+stuck terminal, holds up every key after it. A HandlerProfiler set as
+PluginState.profiler times every handler call, attributing it to the handler's
+plugin, the state it was registered in and the event it handled. Calls over
+budget are warned about as they happen, and summary() sorts handlers by the
+total time they took.
+"""
+import sys
+
+from clock import monotonic
+from latency import plugin_name
+
+
+class HandlerStats(object):
+  def __init__(self):
+    self.calls = 0
+    self.total = 0.0
+    self.max = 0.0
+    self.over_budget = 0
+
+
+class HandlerProfiler(object):
+  def __init__(self, budget=0.005, stream=None):
+    """Warns on stream, stderr by default, of calls taking over budget seconds.
+
+    Only calls slower than any before them from the same handler are warned
+    about, so a handler that's always slow doesn't flood the stream.
+    """
+    self.budget = budget
+    self.stream = stream or sys.stderr
+    # (plugin, state name, event, handler name) to HandlerStats.
+    self.stats = {}
+
+  def call(self, state_name, event, func, *args):
+    start = monotonic()
+    try:
+      return func(*args)
+    finally:
+      self.record(state_name, event, func, monotonic() - start)
+
+  def record(self, state_name, event, func, elapsed):
+    key = (plugin_name(func), state_name, event,
+           getattr(func, '__name__', type(func).__name__))
+    stats = self.stats.get(key)
+    if stats is None:
+      stats = self.stats[key] = HandlerStats()
+    stats.calls += 1
+    stats.total += elapsed
+    if elapsed > self.budget:
+      stats.over_budget += 1
+      if elapsed > stats.max:
+        self.stream.write(
+            'WARNING: %s.%s took %.1fms handling %s in state %s, over the '
+            '%.1fms budget\n' % (key[0], key[3], elapsed * 1e3, event,
+                                 state_name, self.budget * 1e3))
+    if elapsed > stats.max:
+      stats.max = elapsed
+
+  def reset(self):
+    self.stats = {}
+
+  def summary(self):
+    """Returns a table of handlers, those that took the longest first."""
+    lines = ['%-36s %-10s %-14s %7s %9s %8s %8s %5s' % (
+        'handler', 'state', 'event', 'calls', 'total ms', 'mean ms', 'max ms',
+        'slow')]
+    for key, stats in sorted(self.stats.items(),
+                             key=lambda item: item[1].total, reverse=True):
+      plugin, state_name, event, name = key
+      lines.append('%-36s %-10s %-14s %7d %9.2f %8.3f %8.3f %5d' % (
+          '%s.%s' % (plugin, name), state_name, event, stats.calls,
+          stats.total * 1e3, stats.total / stats.calls * 1e3,
+          stats.max * 1e3, stats.over_budget))
+    return '\n'.join(lines)
+
+  def dump(self, stream=None):
+    stream = stream or self.stream
+    stream.write(self.summary() + '\n')
+    stream.flush()
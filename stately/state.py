@@ -2,17 +2,88 @@
 
 Plugins get registered for various actions in each state they wish. This object
 is then passed into plugins that are triggered for those actions.
+
+Besides key_press and key_release, keys can have key_hold handlers, called once
+a key has been held for HOLD_TIME, key_repeat handlers, called every
+REPEAT_INTERVAL after REPEAT_DELAY while it's held, and key_double_tap handlers,
+called when it's pressed again within DOUBLE_TAP_TIME. key_press and
+key_release handlers are still called for those keys.
+
+A PluginState belongs to the thread that creates it, which has to be the one
+dispatching reports. State changes and registrations from any other thread are
+posted to its CommandQueue and happen between reports, see post. So are timer
+callbacks, which therefore run on that thread too.
 """
+import thread
+import threading
 
+from clock import monotonic
+from commands import CommandQueue
 from g13_handler import G13Keys
+from latency import plugin_name
+from timers import TimerWheel
+from workers import KeyedWorkerPool
 
 class PluginState(object):
-  def __init__(self, handler, action_helper):
+  HOLD_TIME = 0.5
+  REPEAT_DELAY = 0.5
+  REPEAT_INTERVAL = 0.05
+  DOUBLE_TAP_TIME = 0.3
+
+  def __init__(self, handler, action_helper, loop=None, workers=0,
+               timers_on_loop=False):
+    """With workers, key and joystick handlers run on worker threads.
+
+    Key handlers all run in order on one worker, and joystick handlers on
+    another, so workers is capped at 2. Handlers are looked up when
+    they run, and state changes they make wait for the dispatch thread, so each
+    event goes to the handlers of the stack the ones before it left.
+
+    Set timers_on_loop when loop runs on the thread dispatching reports, to
+    schedule timers on it rather than on a TimerWheel thread.
+    """
     self.handler = handler
+    # The EventLoop plugins can schedule timers and coroutines on.
+    self.loop = loop
+    self.pool = None
+    if workers < 0:
+      raise ValueError('workers must be 0 or more, got %r' % workers)
+    if workers:
+      # Only the 'keys' and 'joystick' lanes are ever submitted to, so any
+      # more workers would sit idle.
+      self.pool = KeyedWorkerPool(min(workers, 2),
+                                  on_block=self.drain_commands)
+    self.dispatch_thread = thread.get_ident()
+    # Work from other threads for dispatch_thread. The runtime sets its wakeup
+    # to drain it when reports may not come for a while.
+    self.commands = CommandQueue()
+    if timers_on_loop:
+      self.timers = None
+    else:
+      # Timers fire on the wheel's thread, so their callbacks are posted to run
+      # on dispatch_thread like everything else.
+      self.timers = TimerWheel(executor=self.commands.post)
     self.states = {}
     self.stack = []
+    # The stack flattened into what handles each event, see _compile_stack.
+    self.key_press_funcs = {}
+    self.key_release_funcs = {}
+    self.key_hold_funcs = {}
+    self.key_repeat_funcs = {}
+    self.key_double_tap_funcs = {}
+    self.timed_keys = frozenset()
+    self.joystick_funcs = ()
+    # For timed_keys, when they were last pressed and their pending timers.
+    self.last_pressed = {}
+    self.held_timers = {}
+    # Timer passing on a position the joystick filter held back, if any.
+    self.joystick_flush = None
 
     self.action = action_helper
+    # A latency.LatencyTracker, see LatencyTracker.install.
+    self.latency = None
+    # A profiling.HandlerProfiler to time every handler call with.
+    self.profiler = None
 
   @property
   def current_state(self):
@@ -40,6 +111,9 @@ class PluginState(object):
           state[key_action_name][key] = [key_action[key]]
 
   def register_plugin(self, states={}):
+    if thread.get_ident() != self.dispatch_thread:
+      self._post_state_change(self.register_plugin, states)
+      return
     for state_name, actions in states.items():
       if state_name not in self.states:
         self.states[state_name] = {}
@@ -51,13 +125,91 @@ class PluginState(object):
 
       self._register_key_action(state, actions, 'key_press')
       self._register_key_action(state, actions, 'key_release')
+      self._register_key_action(state, actions, 'key_hold')
+      self._register_key_action(state, actions, 'key_repeat')
+      self._register_key_action(state, actions, 'key_double_tap')
+    self._compile_stack()
+
+  def _compile_stack(self):
+    """Resolves which handlers each event goes to for the current stack.
+
+    Going from the bottom of the stack up, each state's handlers replace those
+    of the states under it, so a key's event goes to the topmost state that
+    registered it. Must be called whenever the stack or registrations change.
+    """
+    key_press_funcs = {}
+    key_release_funcs = {}
+    key_hold_funcs = {}
+    key_repeat_funcs = {}
+    key_double_tap_funcs = {}
+    joystick_funcs = ()
+    for state_name in self.stack:
+      state = self.states[state_name]
+      key_press_funcs.update(state.get('key_press', {}))
+      key_release_funcs.update(state.get('key_release', {}))
+      key_hold_funcs.update(state.get('key_hold', {}))
+      key_repeat_funcs.update(state.get('key_repeat', {}))
+      key_double_tap_funcs.update(state.get('key_double_tap', {}))
+      joystick_funcs = state.get('joystick') or joystick_funcs
+    self.key_press_funcs = key_press_funcs
+    self.key_release_funcs = key_release_funcs
+    self.key_hold_funcs = key_hold_funcs
+    self.key_repeat_funcs = key_repeat_funcs
+    self.key_double_tap_funcs = key_double_tap_funcs
+    self.timed_keys = frozenset(key_hold_funcs).union(
+        key_repeat_funcs, key_double_tap_funcs)
+    self.joystick_funcs = joystick_funcs
 
   def handle_state_event(self, event):
     handlers = self.current_state.get(event, [])
-    for handler in handlers:
-      handler(self, self.current_state)
+    self._call_handlers(event, handlers, self.current_state)
+
+  def _call_handlers(self, event, funcs, *args):
+    """Calls func(self, *args) for each of an event's handlers."""
+    profiler = self.profiler
+    latency = self.latency
+    if profiler is None and latency is None:
+      for func in funcs:
+        func(self, *args)
+      return
+    state_name = self._state_of(event, funcs) if profiler is not None else None
+    for func in funcs:
+      if latency is not None:
+        latency.plugin = plugin_name(func)
+      try:
+        if profiler is not None:
+          profiler.call(state_name, event, func, self, *args)
+        else:
+          func(self, *args)
+      finally:
+        if latency is not None:
+          latency.plugin = None
+
+  def _dispatch_key_event(self, event, key):
+    """Calls key's handlers for event, on a worker if there are workers."""
+    if self.pool is None:
+      self._call_key_funcs(event, key)
+    else:
+      self.pool.submit('keys', self._call_key_funcs, event, key)
+
+  def _call_key_funcs(self, event, key):
+    funcs = getattr(self, event + '_funcs').get(key)
+    if funcs:
+      self._call_handlers(event, funcs, key)
+
+  def _state_of(self, event, funcs):
+    """Returns the state in the stack funcs were registered in for event."""
+    for state_name in reversed(self.stack):
+      handlers = self.states[state_name].get(event)
+      if handlers is funcs or (isinstance(handlers, dict) and
+                               any(h is funcs for h in handlers.values())):
+        return state_name
+    return self.current_state_name
 
   def enter_state(self, state_name):
+    if thread.get_ident() != self.dispatch_thread:
+      self._post_state_change(self.enter_state, state_name)
+      return
     if state_name == self.current_state_name:
       return
 
@@ -65,43 +217,156 @@ class PluginState(object):
     if state_name not in self.states:
       print 'WARNING: Entering unregistered state:', state_name
       self.states[state_name] = {}
+    self._compile_stack()
     self.handle_state_event('enter')
 
   def exit_state(self, state_name):
+    if thread.get_ident() != self.dispatch_thread:
+      self._post_state_change(self.exit_state, state_name)
+      return
     # Only pop off states.
     if state_name != self.current_state_name:
       return
 
     self.handle_state_event('exit')
     self.stack.remove(state_name)
+    self._compile_stack()
+
+  # Cross-thread commands
+  def post(self, func, *args):
+    """Calls func(*args) on the dispatch thread, before the next report.
+
+    Safe from any thread. enter_state, exit_state and register_plugin post
+    themselves when called from other threads, anything else touching plugin
+    or ActionHelper registrations from another thread should be posted.
+    """
+    self.commands.post(func, *args)
+
+  def _post_state_change(self, func, *args):
+    """Posts func, waiting for it to run if called from a handler worker.
+
+    The worker's next event then sees the stack func left.
+    """
+    if self.pool is None or not self.pool.is_worker():
+      self.post(func, *args)
+      return
+    done = threading.Event()
+    def change():
+      try:
+        func(*args)
+      finally:
+        done.set()
+    self.post(change)
+    done.wait()
+
+  def drain_commands(self):
+    """Runs posted commands, called by the dispatch thread between reports."""
+    if self.commands:
+      self.commands.drain()
+
+  def stop(self):
+    """Stops timers and, once they've run what's queued, the workers."""
+    if self.timers is not None:
+      self.timers.stop()
+    if self.pool is not None:
+      self.pool.stop()
+
+  # Timers
+  def call_later(self, delay, func, *args):
+    """Calls func(*args) after delay seconds, returns a handle to cancel()."""
+    timers = self.timers if self.timers is not None else self.loop
+    return timers.call_later(delay, func, *args)
+
+  def call_every(self, interval, func, *args, **kwargs):
+    """Calls func(*args) every interval seconds until cancelled.
+
+    Pass delay to have the first call after something other than interval.
+    """
+    timers = self.timers if self.timers is not None else self.loop
+    return timers.call_every(interval, func, *args, **kwargs)
+
+  def dispatch_keys(self, new_keys, events):
+    """Dispatches a report's joystick position and key events."""
+    if self.commands:
+      self.commands.drain()
+    joystick_filter = self.handler.joystick_filter
+    stick = joystick_filter(new_keys.stick_x, new_keys.stick_y)
+    if stick:
+      self.joystick(*stick)
+    elif joystick_filter.pending is not None and self.joystick_flush is None:
+      self._schedule_joystick_flush()
+    for key, is_pressed in events:
+      self.key_changed(key, is_pressed)
 
   def key_changed(self, key, is_pressed):
-    local_stack = list(self.stack)
-    while local_stack:
-      state = local_stack.pop()
+    latency = self.latency
+    if latency is not None:
+      latency.dispatching(key)
+    event = 'key_press' if is_pressed else 'key_release'
+    if self.pool is not None:
+      self._dispatch_key_event(event, key)
+    else:
+      if is_pressed:
+        funcs = self.key_press_funcs.get(key)
+      else:
+        funcs = self.key_release_funcs.get(key)
+      if funcs:
+        self._call_handlers(event, funcs, key)
+    if key in self.timed_keys or key in self.held_timers:
       if is_pressed:
-        keys = self.states[state].get('key_press', {})
+        self._timed_key_pressed(key)
       else:
-        keys = self.states[state].get('key_release', {})
+        self._timed_key_released(key)
+    if latency is not None:
+      latency.dispatched()
 
-      funcs = keys.get(key)
-      if not funcs:
-        # If nothing's registered, try the previous state.
-        continue
-      [func(self, key) for func in funcs]
-      break
+  def _timed_key_pressed(self, key):
+    now = monotonic()
+    last_pressed = self.last_pressed.get(key)
+    self.last_pressed[key] = now
+    funcs = self.key_double_tap_funcs.get(key)
+    if (funcs and last_pressed is not None and
+        now - last_pressed <= self.DOUBLE_TAP_TIME):
+      # A third tap starts over rather than being another double tap.
+      del self.last_pressed[key]
+      self._dispatch_key_event('key_double_tap', key)
+
+    timers = []
+    if key in self.key_hold_funcs:
+      timers.append(self.call_later(
+          self.HOLD_TIME, self._dispatch_key_event, 'key_hold', key))
+    if key in self.key_repeat_funcs:
+      timers.append(self.call_every(
+          self.REPEAT_INTERVAL, self._dispatch_key_event, 'key_repeat', key,
+          delay=self.REPEAT_DELAY))
+    if timers:
+      self.held_timers[key] = timers
+
+  def _timed_key_released(self, key):
+    for timer in self.held_timers.pop(key, ()):
+      timer.cancel()
 
   def joystick(self, stick_x, stick_y):
-    # Similar to key_changed, but collapsing them will cause a huge
-    # hit to readability since joystick isn't a dict while
-    # key_press/release is.
-    local_stack = list(self.stack)
-    while local_stack:
-      state = local_stack.pop()
-      funcs = self.states[state].get('joystick', [])
-
-      if not funcs:
-        continue
-      [func(self, stick_x, stick_y) for func in funcs]
-      break
+    if self.pool is not None:
+      self.pool.submit('joystick', self._call_joystick_funcs, stick_x, stick_y)
+    else:
+      self._call_joystick_funcs(stick_x, stick_y)
+
+  def _schedule_joystick_flush(self):
+    self.joystick_flush = self.call_later(
+        self.handler.joystick_filter.flush_delay(), self._flush_joystick)
+
+  def _flush_joystick(self):
+    """Passes on where the stick stopped if no report after it did."""
+    self.joystick_flush = None
+    joystick_filter = self.handler.joystick_filter
+    stick = joystick_filter.flush()
+    if stick:
+      self.joystick(*stick)
+    elif joystick_filter.pending is not None:
+      # Another position went through since, so its window starts over.
+      self._schedule_joystick_flush()
 
+  def _call_joystick_funcs(self, stick_x, stick_y):
+    if self.joystick_funcs:
+      self._call_handlers('joystick', self.joystick_funcs, stick_x, stick_y)
@@ -0,0 +1,216 @@
+"""Timer wheel shared by all plugins.
+
+TimerWheel keeps every pending timer in a hashed wheel of slots, each slot
+holding the timers due on ticks that map to it. Adding and cancelling a timer
+are O(1), and however many timers are pending they're all run from a single
+thread that only wakes up for slots that have timers in them. Deadlines go by
+the monotonic clock, so setting the wall clock doesn't stall or burst them.
+
+Python 2's Condition.wait(timeout) polls, waking up as much as 50ms late, so on
+Unix the thread sleeps in select() on a pipe instead.
+"""
+import errno
+import math
+import os
+import select
+import threading
+
+from clock import monotonic
+
+
+class _Wakeup(object):
+  """Lets one thread sleep until a timeout or until another wakes it up."""
+  def __init__(self):
+    if os.name == 'posix':
+      self.event = None
+      self.read_fd, self.write_fd = os.pipe()
+    else:
+      # select() only takes sockets on Windows, so poll.
+      self.event = threading.Event()
+
+  def wait(self, timeout=None):
+    if self.event is not None:
+      self.event.wait(timeout)
+      self.event.clear()
+      return
+    try:
+      readable = select.select([self.read_fd], [], [], timeout)[0]
+    except select.error as e:
+      if e.args[0] != errno.EINTR:
+        raise
+      return
+    if readable:
+      os.read(self.read_fd, 4096)
+
+  def set(self):
+    if self.event is not None:
+      self.event.set()
+    else:
+      os.write(self.write_fd, b'x')
+
+  def close(self):
+    if self.event is None and self.read_fd is not None:
+      os.close(self.read_fd)
+      os.close(self.write_fd)
+      self.read_fd = self.write_fd = None
+
+
+class Timer(object):
+  """A pending call, cancel() stops it from running (again)."""
+  __slots__ = ('wheel', 'callback', 'args', 'interval', 'deadline', 'tick',
+               'cancelled')
+
+  def __init__(self, wheel, callback, args, interval=None):
+    self.wheel = wheel
+    self.callback = callback
+    self.args = args
+    self.interval = interval
+    self.deadline = None
+    self.tick = None
+    self.cancelled = False
+
+  def cancel(self):
+    self.cancelled = True
+    self.wheel._remove(self)
+
+
+class TimerWheel(object):
+  """Runs timers with resolution seconds of precision on one thread.
+
+  executor is called as executor(callback, *args) to run each due timer,
+  e.g. EventLoop.call_soon_threadsafe to run them on the loop's thread. By
+  default they run on the wheel's own thread.
+  """
+  def __init__(self, resolution=0.001, slots=512, executor=None):
+    self.resolution = resolution
+    self.slots = [set() for _ in range(slots)]
+    self.executor = executor
+    self.lock = threading.Lock()
+    self.wakeup = _Wakeup()
+    # The tick the thread is sleeping until, float('inf') for no timers, or
+    # None while it's awake or already being woken up.
+    self.sleeping_until = None
+    self.start_time = monotonic()
+    self.current_tick = 0
+    self.pending = 0
+    self.thread = None
+    self.stopped = False
+
+  def call_later(self, delay, callback, *args):
+    timer = Timer(self, callback, args)
+    self._add(timer, monotonic() + delay)
+    return timer
+
+  def call_every(self, interval, callback, *args, **kwargs):
+    """Calls callback every interval seconds.
+
+    The first call is after interval seconds, or delay if it's given.
+    """
+    timer = Timer(self, callback, args, interval)
+    self._add(timer, monotonic() + kwargs.get('delay', interval))
+    return timer
+
+  def stop(self):
+    """Stops the thread, waiting for it unless called from a timer on it.
+
+    Timers can't be added afterwards.
+    """
+    with self.lock:
+      self.stopped = True
+      thread = self.thread
+    self.wakeup.set()
+    if thread is threading.current_thread():
+      return
+    if thread is not None:
+      thread.join()
+    self.wakeup.close()
+
+  def _tick_for(self, when):
+    return int(math.ceil((when - self.start_time) / self.resolution))
+
+  def _add(self, timer, deadline):
+    with self.lock:
+      if timer.cancelled or self.stopped:
+        return
+      timer.deadline = deadline
+      timer.tick = max(self._tick_for(deadline), self.current_tick + 1)
+      self.slots[timer.tick % len(self.slots)].add(timer)
+      self.pending += 1
+      if self.thread is None:
+        self.thread = threading.Thread(target=self._run, name='TimerWheel')
+        self.thread.daemon = True
+        self.thread.start()
+      elif (self.sleeping_until is not None and
+            timer.tick < self.sleeping_until):
+        # Due before the thread would wake up, so wake it up now, once.
+        self.sleeping_until = None
+        self.wakeup.set()
+
+  def _remove(self, timer):
+    with self.lock:
+      slot = self.slots[timer.tick % len(self.slots)] if timer.tick else ()
+      if timer in slot:
+        slot.remove(timer)
+        self.pending -= 1
+
+  def _next_tick(self):
+    """Returns the first tick with timers in its slot, they may not be due."""
+    num_slots = len(self.slots)
+    start = self.current_tick + 1
+    for tick in xrange(start, start + num_slots):
+      if self.slots[tick % num_slots]:
+        return tick
+    return None
+
+  def _run(self):
+    while True:
+      with self.lock:
+        self.sleeping_until = None
+        if self.stopped:
+          return
+        now_tick = int((monotonic() - self.start_time) / self.resolution)
+        sleep = now_tick <= self.current_tick
+        if sleep:
+          next_tick = self._next_tick() if self.pending else None
+          if next_tick is None:
+            self.sleeping_until = float('inf')
+            timeout = None
+          else:
+            self.sleeping_until = next_tick
+            timeout = max(0, self.start_time + next_tick * self.resolution -
+                          monotonic())
+      if sleep:
+        self.wakeup.wait(timeout)
+        continue
+
+      with self.lock:
+        due = []
+        num_slots = len(self.slots)
+        # Every slot is looked at once at most, however long we slept.
+        for tick in xrange(self.current_tick + 1,
+                           min(now_tick, self.current_tick + num_slots) + 1):
+          slot = self.slots[tick % num_slots]
+          if slot:
+            ready = [timer for timer in slot if timer.tick <= now_tick]
+            slot.difference_update(ready)
+            due.extend(ready)
+        self.current_tick = now_tick
+        self.pending -= len(due)
+
+      due.sort(key=lambda timer: timer.tick)
+      for timer in due:
+        if timer.cancelled:
+          continue
+        if timer.interval is not None:
+          # From the deadline rather than now, so it doesn't drift.
+          self._add(timer, max(timer.deadline + timer.interval, monotonic()))
+        if self.executor is None:
+          self._fire(timer)
+        else:
+          self.executor(self._fire, timer)
+
+  @staticmethod
+  def _fire(timer):
+    # Checked again here since the executor may run it a little later.
+    if not timer.cancelled:
+      timer.callback(*timer.args)
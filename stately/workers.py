@@ -0,0 +1,81 @@
+"""Runs plugin handlers off the thread reading key reports.
+
+KeyedWorkerPool hands each lane to one of a fixed set of worker threads the
+first time it's seen, and runs all of that lane's tasks there, in the order
+they were submitted. PluginState uses one lane for all key events and one for
+the joystick, so key handlers stay in order with each other and with the
+state changes they make, while a slow key handler doesn't hold up the
+joystick, or the reads.
+"""
+import Queue
+import threading
+import traceback
+
+
+class KeyedWorkerPool(object):
+  def __init__(self, workers=2, max_pending=256, on_block=None):
+    """Starts workers threads, each queueing up to max_pending tasks.
+
+    Lanes are spread over the workers round robin, so more workers than lanes
+    just sit idle.
+
+    submit blocks while the queue it needs is full, so a handler that's stuck
+    for good eventually stops reads rather than growing its queue forever.
+    While submit or stop are blocked they call on_block every few ms, e.g. to
+    run commands the workers are waiting on.
+    """
+    self.queues = [Queue.Queue(max_pending) for _ in range(workers)]
+    self.assignments = {}
+    self.on_block = on_block
+    self.threads = []
+    for i, queue in enumerate(self.queues):
+      thread = threading.Thread(
+          target=self._work, args=(queue,), name='HandlerWorker-%d' % i)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def submit(self, lane, func, *args):
+    """Calls func(*args) on lane's worker, after its earlier tasks."""
+    queue = self.assignments.get(lane)
+    if queue is None:
+      queue = self.assignments.setdefault(
+          lane, self.queues[len(self.assignments) % len(self.queues)])
+    self._put(queue, (func, args))
+
+  def _put(self, queue, task):
+    while True:
+      try:
+        queue.put(task, timeout=0.005)
+        return
+      except Queue.Full:
+        if self.on_block is not None:
+          self.on_block()
+
+  def is_worker(self):
+    """Returns whether the calling thread is one of the workers."""
+    return threading.current_thread() in self.threads
+
+  def _work(self, queue):
+    while True:
+      task = queue.get()
+      if task is None:
+        return
+      func, args = task
+      try:
+        func(*args)
+      except Exception:
+        # Keep the worker, and every lane assigned to it, going.
+        traceback.print_exc()
+
+  def stop(self):
+    """Runs the tasks already submitted, then stops the workers."""
+    for queue in self.queues:
+      self._put(queue, None)
+    for thread in self.threads:
+      if thread is threading.current_thread():
+        continue
+      while thread.is_alive():
+        thread.join(0.005)
+        if self.on_block is not None:
+          self.on_block()
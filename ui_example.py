@@ -1,15 +1,9 @@
 import datetime
 import sys
-import threading
 import time
 
-import numpy
-from scipy import weave
-
-import usb1
-import libusb1
-
-from g13 import G13, MissingG13Error
+from g13 import G13, G13TimeoutError, MissingG13Error
+from lcd import BitmapFont, ImageCache
 
 import cairo
 
@@ -139,6 +133,11 @@ class G13UI(object):
     self.context.set_source_rgb(1, 1, 1)
     self.context.select_font_face('Verdana')
     self.context.set_font_size(35)
+    # The clock is drawn from pre-packed glyphs, not through the surface.
+    self.font = BitmapFont.get('Verdana', 35)
+    self.time_end = 0
+    # So are images, each loaded and packed once.
+    self.images = ImageCache()
 
   def reset(self):
     self.context.set_operator(cairo.OPERATOR_CLEAR)
@@ -146,62 +145,17 @@ class G13UI(object):
     self.context.set_operator(cairo.OPERATOR_OVER)
 
   def print_time(self):
-    self.reset()
-
-    width, height = self.context.text_extents('aA')[2:4]
-    self.context.move_to(0, height)
     text = datetime.datetime.now().strftime('%I:%M:%S.%f')
-    self.context.show_text(text)
-    self.draw_surface()
+    self.time_end = self.font.draw(self.g13, text, clear_to=self.time_end)
+    self.g13.write_lcd_bg()
 
   def draw_image(self, filename, scale=1, offset=(0, 0)):
-    self.context.save()
-    new_surface = cairo.ImageSurface.create_from_png(filename)
-    self.context.scale(scale, scale)
-    self.context.set_source_surface(new_surface, *offset)
-    self.context.paint()
-    self.context.restore()
-    self.draw_surface()
+    self.images.draw(self.g13, filename, scale, offset)
+    self.g13.write_lcd_bg()
 
   def draw_surface(self):
-    source = self.surface.get_data()
-    dest = self.g13.pixels
-    width = self.g13.LCD_WIDTH
-    threshold = 128
-    support_code = """
-    #define RGB_R(x) ((x&0x00FF0000) >> 16)
-    #define RGB_G(x) ((x&0x0000FF00) >> 8)
-    #define RGB_B(x) ((x&0x000000FF) >> 0)
-    """
-    c_code = """
-    Py_buffer source_buffer;
-    PyObject_GetBuffer(source, &source_buffer, PyBUF_WRITABLE);
-
-    unsigned int* source_buf = (unsigned int*)source_buffer.buf;
-    int source_len = source_buffer.len;
-
-    char* dest_buf = PyByteArray_AsString(dest);
-
-    int row = 0, col = 0;
-    for (int pi=0; pi < source_len / 4; pi++) {
-      int pix = source_buf[pi];
-      bool pixel = RGB_R(pix) > %(threshold)s ||
-                   RGB_G(pix) > %(threshold)s ||
-                   RGB_B(pix) > %(threshold)s;
-      int idx = 32 + col + (row >> 3) * %(width)s;
-      if (pixel)
-        dest_buf[idx] |= 1 << (row & 0x07);
-      else
-        dest_buf[idx] &= ~(1 << (row & 0x07));
-
-      col++;
-      if (col >= %(width)s) {
-        col = 0;
-        row++;
-      }
-    }
-    """ % {'width': width, 'threshold': threshold}
-    weave.inline(c_code, ['source', 'dest'], support_code=support_code)
+    self.g13.blit_surface(self.surface.get_data(), cairo.FORMAT_RGB24,
+                          stride=self.surface.get_stride())
     self.g13.write_lcd_bg()
 
   def print_block(self, x, y, val):
@@ -218,22 +172,8 @@ class G13UI(object):
     self.prev_x, self.prev_y = x, y
 
 
-class G13Wrapper(G13):
-  def __init__(self):
-    super(G13Wrapper, self).__init__()
-    self.lock = threading.Lock()
-
-  def write_lcd_bg(self):
-    threading.Thread(target=self.write_lcd).start()
-
-  def write_lcd(self):
-    if self.lock.acquire(False):
-      super(G13Wrapper, self).write_lcd()
-      self.lock.release()
-
-
 def main(argv):
-  g13 = G13Wrapper()
+  g13 = G13()
   try:
     g13.open()
   except MissingG13Error:
@@ -246,6 +186,7 @@ def main(argv):
   g13.set_mode_leds(int(time.time() % 16))
   g13.set_color((255, 255, 255))
 
+  g13.start_lcd_writer(max_fps=30)
   g13ui = G13UI(g13)
 
   g13ui.draw_image('x.png', scale=0.2, offset=(200, 0))
@@ -276,14 +217,15 @@ def main(argv):
 
         ui.flush()
         g13.write_lcd_bg()
-      except libusb1.USBError as e:
-        if e.value == -7:
-          pass
+      except G13TimeoutError:
+        pass
   except Exception as e:
     print e
   except KeyboardInterrupt:
     print '^C'
 
+  print 'LCD frames sent: %d, skipped: %d' % (
+      g13.frames_sent, g13.frames_skipped)
   g13.close()
 
 